@@ -28,18 +28,80 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import array
 import ast
+import collections.abc
+import contextlib
+import hashlib
+import io
+import itertools
+import mmap
+import multiprocessing
 import pickle
 import math
 import os.path
 import random
 import signal
+import sqlite3
+import struct
 import sys
+import threading
+import zlib
+
+"""Journal records: the operation, then the lengths of the key and value."""
+JOURNAL_HEADER=struct.Struct("<BII")
+JOURNAL_STORE=1
+JOURNAL_REMOVE=2
+
+"""Number of keys whose cache slot is remembered by each Cache."""
+SLOT_MEMO_SIZE=65536
+
+"""Number of keys and values whose size is remembered for failureTime."""
+PAYLOAD_MEMO_SIZE=65536
+
+"""Number of bits in each byte value that a Channel can flip, up to and
+   including the leading 0.
+"""
+BIT_LENGTHS=bytes(i.bit_length()+1 for i in range(256))
+
+"""Losing the sign of a negative number is as likely as any of this many
+   bits flipping.
+"""
+SIGN_UNITS=8
+
+"""Ways a full Cache can choose an entry to evict."""
+EVICTION_POLICIES=("LRU","CLOCK","RANDOM")
+"""Number of locks that keys are spread over in concurrent mode."""
+LOCK_STRIPES=64
+
+"""Statements used by SQLiteDataBase. sqlite3 keeps them prepared."""
+SQL_CREATE="CREATE TABLE IF NOT EXISTS crusher (k BLOB PRIMARY KEY, v BLOB) WITHOUT ROWID"
+SQL_STORE="INSERT OR REPLACE INTO crusher (k, v) VALUES (?, ?)"
+SQL_FETCH="SELECT v FROM crusher WHERE k=?"
+SQL_REMOVE="DELETE FROM crusher WHERE k=?"
+SQL_ITEMS="SELECT k, v FROM crusher"
+"""Pickle protocol of the keys stored by SQLiteDataBase. It is fixed, so
+   that every version of Python stores a key the same way.
+"""
+SQL_KEY_PROTOCOL=4
+
+"""Indexed snapshots: the magic number, then the number of entries, the
+   number of index slots and the offset of the index. Each record is the
+   lengths of the pickled key and value, followed by the pickles. Each index
+   slot is the hash of a key and the offset of its record, or 0 if empty.
+"""
+SNAPSHOT_MAGIC=b"CRUSHIX1"
+SNAPSHOT_HEADER=struct.Struct("<8sQQQ")
+SNAPSHOT_RECORD=struct.Struct("<II")
+SNAPSHOT_SLOT=struct.Struct("<QQ")
 
 def failure(rate, data):
     """Return whether any failures happened processing data with
        the given rate.
     """
+    if(rate<=0):
+        """Nothing can fail, so do not bother sizing data."""
+        return False
     return (random.random() >= math.exp(-failureTime(rate,data)))
 
 def failures(rate, n):
@@ -56,11 +118,161 @@ def failures(rate, n):
         prob=prob*t/n
     return n
 
+def keyHash(key):
+    """Return a 64-bit hash of key that is stable between runs.
+       Keys are hashed by their repr, so keys that are equal but print
+       differently, such as 1 and 1.0, are treated as different keys.
+    """
+    h=hashlib.blake2b(repr(key).encode("utf-8","backslashreplace"), digest_size=8)
+    return int.from_bytes(h.digest(), "little")
+
 def failureTime(rate, data):
     """Return the amount of time based on the rate and number
        of bits in data.
     """
-    return rate*len(str(data))*8
+    return rate*payloadBits(data)
+
+"""Memo of the size of recently seen data, oldest first. Brokers in
+   concurrent mode share it between threads, so it is only changed while
+   holding payloadLock.
+"""
+payloadSizes={}
+payloadLock=threading.Lock()
+
+def payloadBits(data):
+    """Return the number of bits in data, as 8 bits for each character
+       of str(data).
+       The size of recently seen data is remembered, so data that goes
+       through several channels and the cache is only converted to a
+       string once. Data that is equal shares the size of the first one
+       seen.
+       Looking data up is a single dict operation, so it needs no lock.
+    """
+    try:
+        return payloadSizes[data]
+    except KeyError:
+        """Not seen recently, so compute it below."""
+    except TypeError:
+        """Unhashable data cannot be remembered."""
+        return len(str(data))*8
+    n=len(str(data))*8
+    with payloadLock:
+        if(len(payloadSizes)>=PAYLOAD_MEMO_SIZE):
+            """Forget the oldest data."""
+            del payloadSizes[next(iter(payloadSizes))]
+        payloadSizes[data]=n
+    return n
+
+def bitUnits(data):
+    """Return the number of bits of data that can be flipped by a Channel.
+       A negative number has an extra SIGN_UNITS for losing its sign.
+    """
+    t=type(data)
+    if(t is str):
+        try:
+            return sum(data.encode("latin-1").translate(BIT_LENGTHS))
+        except UnicodeEncodeError:
+            return sum(ord(c).bit_length()+1 for c in data)
+    if(t is tuple or t is list):
+        return sum(map(bitUnits, data))
+    if(t is int or t is bool):
+        if(data<0):
+            return (-data).bit_length()+1+SIGN_UNITS
+        return data.bit_length()+1
+    if(t is float):
+        return SIGN_UNITS if data<0 else 0
+    if(t is bytes):
+        return 8*len(data)
+    return 0
+
+def freeze(data):
+    """Return data with any lists in it, and itself if it is a list, turned
+       into tuples, so that it can be used as a key. Channels do this even
+       if nothing flips.
+    """
+    t=type(data)
+    if(t is tuple):
+        try:
+            hash(data)
+            return data
+        except TypeError:
+            """There is a list in it somewhere."""
+    elif(t is not list):
+        return data
+    return tuple(freeze(x) if type(x) is list or type(x) is tuple else x for x in data)
+
+def flipBits(data, flips):
+    """Return data with the bits at the sorted positions flips changed.
+       The positions are numbered as counted by bitUnits.
+    """
+    t=type(data)
+    if(t is tuple or t is list or t is str):
+        """Hand each item the flips that land in it."""
+        out=[]
+        start=0
+        i=0
+        for x in data:
+            if(t is str):
+                n=ord(x).bit_length()+1
+            else:
+                n=bitUnits(x)
+            j=i
+            while(j<len(flips) and flips[j]<start+n):
+                j+=1
+            if(j>i):
+                if(t is str):
+                    x=chr(flipBits(ord(x), [p-start for p in flips[i:j]]))
+                else:
+                    x=flipBits(x, [p-start for p in flips[i:j]])
+                i=j
+            out.append(x)
+            start+=n
+        if(t is str):
+            return "".join(out)
+        return tuple(out)
+    if(t is bytes):
+        b=bytearray(data)
+        for p in flips:
+            b[p>>3]^=1<<(p&7)
+        return bytes(b)
+    if(data<0):
+        """The bits of the magnitude come first, then the sign."""
+        n=0 if t is float else (-data).bit_length()+1
+        mag=flipBits(-data, [p for p in flips if p<n])
+        if(flips[-1]>=n):
+            """Sign failure"""
+            return mag
+        return -mag
+    for p in flips:
+        data=data^(1<<p)
+    return data
+
+class AtomicCounter:
+    """A counter that several threads can add to at once with +=."""
+    def __init__(self, n=0):
+        """Create a counter starting at n."""
+        self.n=n
+        self.lock=threading.Lock()
+    def __iadd__(self, k):
+        """Add k to the counter."""
+        with self.lock:
+            self.n+=k
+        return self
+    def __int__(self):
+        return self.n
+    __index__=__int__
+    def __format__(self, spec):
+        return format(self.n, spec)
+    def __repr__(self):
+        return repr(self.n)
+
+def stripeLock(locks, key):
+    """Return the lock from locks for key."""
+    try:
+        return locks[hash(key)%len(locks)]
+    except TypeError:
+        """Unhashable keys use the lock for their repr."""
+        return locks[hash(repr(key))%len(locks)]
 
 class Cache:
     """Noisy Cache: a cache that is suceptible to failures."""
@@ -72,9 +284,36 @@ class Cache:
            s[2] is the failure rate for Random Hits.
            s[3] is the failure rate for Key Half-Writes.
            s[4] is the failure rate for Value Half-Writes.
+           s[5] is optional, the most entries the cache holds, or 0 for
+                no limit.
+           s[6] is optional, the eviction policy when the cache is full:
+                "LRU", "CLOCK" or "RANDOM".
+           s[7] is optional, the number of ways: how many keys that share a
+                slot can be in the cache at once.
         """
         self.settings=s
         self.cache={}
+        """The resident slots in an array, and the position of each slot in
+           the array, so a resident entry can be picked at random quickly.
+        """
+        self.order=[]
+        self.pos={}
+        """Memo of the slot for recently used keys, oldest first."""
+        self.slots={}
+        self.slotLimit=SLOT_MEMO_SIZE
+        self.capacity=0
+        self.policy="LRU"
+        self.ways=1
+        """When each line of a multi-way cache was last used."""
+        self.stamp={}
+        self.clock=0
+        """Slots referenced since the CLOCK hand last passed them."""
+        self.ref=set()
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+        self.conflicts=0
+        self.config(s)
     def config(self, s):
         """Update cache settings with a list of cache settings,
            s[0] is the size of the cache: the size of the key converted with
@@ -83,26 +322,195 @@ class Cache:
            s[2] is the failure rate for Random Hits.
            s[3] is the failure rate for Key Half-Writes.
            s[4] is the failure rate for Value Half-Writes.
+           s[5] is optional, the most entries the cache holds, or 0 for
+                no limit.
+           s[6] is optional, the eviction policy when the cache is full:
+                "LRU", "CLOCK" or "RANDOM".
+           s[7] is optional, the number of ways: how many keys that share a
+                slot can be in the cache at once.
+           The capacity, policy and ways are unchanged if they are not given.
+           Changing the number of ways empties the cache.
         """
+        if(s[0]!=self.settings[0]):
+            """The slots depend on the size, so forget them."""
+            self.slots.clear()
         self.settings=s
+        if(len(s)>5):
+            self.capacity=s[5]
+        if(len(s)>6):
+            if s[6] not in EVICTION_POLICIES:
+                raise ValueError("Unknown eviction policy {}".format(s[6]))
+            self.policy=s[6]
+            self.ref.clear()
+        if(len(s)>7 and s[7]!=self.ways):
+            while self.order:
+                self.drop(self.order[-1])
+            self.ways=s[7]
+        while(self.capacity and len(self.cache)>self.capacity):
+            self.evict()
+    def isNoisy(self):
+        """Return whether the cache can give back something other than what
+           was stored.
+        """
+        return any(r>0 for r in self.settings[1:5])
+    def clear(self):
+        """Empty the cache."""
+        self.cache.clear()
+        self.order.clear()
+        self.pos.clear()
+        self.ref.clear()
+        self.stamp.clear()
+    def stats(self):
+        """Return the hit, miss, eviction and conflict counts, the hit rate
+           and the number of entries in the cache.
+           Evictions make room in a full cache. Conflicts replace another
+           key that uses the same slot. Every miss is a fetch that has to
+           fall back to the database.
+        """
+        n=self.hits+self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "rate": self.hits/n if n else 0.0,
+                "evictions": self.evictions, "conflicts": self.conflicts,
+                "entries": len(self.cache)}
+    def touch(self,hk):
+        """Note that the entry in slot hk was used."""
+        if(self.policy=="LRU"):
+            """Move it to the end, which is the most recently used."""
+            self.cache[hk]=self.cache.pop(hk)
+        elif(self.policy=="CLOCK"):
+            self.ref.add(hk)
+    def victim(self):
+        """Return the slot of the entry that the eviction policy would
+           remove next.
+        """
+        if(self.policy=="RANDOM"):
+            return self.order[random.randrange(len(self.order))]
+        """The oldest entry is first. For CLOCK, entries that were used
+           since the hand passed get a second chance at the end.
+        """
+        hk=next(iter(self.cache))
+        while hk in self.ref:
+            self.ref.discard(hk)
+            self.cache[hk]=self.cache.pop(hk)
+            hk=next(iter(self.cache))
+        return hk
+    def evict(self):
+        """Remove one entry from the cache, chosen by the eviction policy."""
+        self.drop(self.victim())
+        self.evictions+=1
+    def insert(self,line,entry):
+        """Put entry in the empty line, making room for it if the cache is
+           full.
+        """
+        if(self.capacity and len(self.cache)>=self.capacity):
+            """Make room for the new entry."""
+            self.evict()
+        self.pos[line]=len(self.order)
+        self.order.append(line)
+        self.cache[line]=entry
+    def randomEntry(self):
+        """Return a random entry from the cache."""
+        return self.cache[self.order[random.randrange(len(self.order))]]
+    def drop(self,hk):
+        """Remove the entry in slot hk, moving the last slot in the array
+           into its place.
+        """
+        del self.cache[hk]
+        self.ref.discard(hk)
+        self.stamp.pop(hk,None)
+        i=self.pos.pop(hk)
+        last=self.order.pop()
+        if(i<len(self.order)):
+            self.order[i]=last
+            self.pos[last]=i
     def hash(self,key):
         """Compute the location of a key in cache. The key is pickled, and some
            number of trailing bytes is returned based on the cache size
            setting.
+           The location of recently used keys is remembered, so keys that
+           are equal share the location of the first one seen.
+        """
+        try:
+            return self.slots[key]
+        except KeyError:
+            """Not seen recently, so compute it below."""
+        except TypeError:
+            """Unhashable keys cannot be remembered."""
+            return pickle.dumps(key)[-self.settings[0]:]
+        h=pickle.dumps(key)[-self.settings[0]:]
+        if(len(self.slots)>=self.slotLimit):
+            """Forget the oldest key."""
+            del self.slots[next(iter(self.slots))]
+        self.slots[key]=h
+        return h
+    def lines(self,hk):
+        """Return the lines for each way of slot hk. The first way uses
+           the slot itself.
         """
-        h=pickle.dumps(key)
-        return h[-self.settings[0]:]
+        return [hk]+[(hk,w) for w in range(1,self.ways)]
+    def use(self,line):
+        """Note that the line of a multi-way cache was used."""
+        self.clock+=1
+        self.stamp[line]=self.clock
     def store(self,key,val):
         """Store the key-value pair in the cache."""
         hk=self.hash(key)
-        if(hk in self.cache.keys()):
+        if(self.ways>1):
+            return self.storeWays(hk,key,val)
+        e=self.cache.get(hk)
+        if(e!=None):
+            if(e[0]!=key):
+                self.conflicts+=1
             if(failure(self.settings[3],key)):
                 """Key Half-Write Failure"""
-                key=self.cache[self.hash(key)][0]
+                key=e[0]
             if(failure(self.settings[4],val)):
                 """Value Half-Write Failure"""
-                val=self.cache[self.hash(key)][1]
-        self.cache[self.hash(key)]=(key,val)
+                val=e[1]
+            if self.capacity:
+                self.touch(hk)
+            self.cache[hk]=(key,val)
+        else:
+            self.insert(hk,(key,val))
+    def storeWays(self,hk,key,val):
+        """Store the key-value pair in a multi-way cache. The key replaces
+           itself if it is already in the slot, otherwise it goes in an
+           empty way, otherwise it replaces the least recently used way.
+           The Half-Write failures apply to the way that is replaced.
+        """
+        free=None
+        oldest=None
+        for line in self.lines(hk):
+            e=self.cache.get(line)
+            if(e==None):
+                if(free==None):
+                    free=line
+            elif(e[0]==key):
+                break
+            elif(oldest==None or self.stamp[line]<self.stamp[oldest]):
+                oldest=line
+        else:
+            """The key is not in the slot."""
+            if(free!=None):
+                line=free
+                e=None
+            else:
+                line=oldest
+                e=self.cache[line]
+                self.conflicts+=1
+        if(e!=None):
+            if(failure(self.settings[3],key)):
+                """Key Half-Write Failure"""
+                key=e[0]
+            if(failure(self.settings[4],val)):
+                """Value Half-Write Failure"""
+                val=e[1]
+            if self.capacity:
+                self.touch(line)
+            self.cache[line]=(key,val)
+        else:
+            self.insert(line,(key,val))
+        self.use(line)
     def fetch(self,key):
         """Retrieve a cached value, if found. Raises a KeyError if not found
            in cache.
@@ -110,33 +518,380 @@ class Cache:
         n=len(self.cache)
         if(n==0):
              """Early exit if the cache is empty."""
+             self.misses+=1
              raise KeyError(key)
         hk=self.hash(key)
         if(failure(self.settings[2],key)):
             """Random Hit Failure"""
-            return list(self.cache.values())[random.randrange(n)]
+            self.hits+=1
+            return self.randomEntry()
+        if(self.ways>1):
+            return self.fetchWays(hk,key)
         if(hk in self.cache):
             e=self.cache[hk]
             if(e[0]==key or failure(self.settings[1],key)):
                 """True Hit or False Hit Failure"""
+                self.hits+=1
+                if self.capacity:
+                    self.touch(hk)
                 return e[1]
         """If not found in cache, raise KeyError."""
+        self.misses+=1
         raise KeyError(key)
+    def fetchWays(self,hk,key):
+        """Retrieve a value from a multi-way cache, if found. A way holding
+           another key can give a False Hit.
+        """
+        found=[line for line in self.lines(hk) if line in self.cache]
+        for line in found:
+            if(self.cache[line][0]==key):
+                break
+        else:
+            for line in found:
+                if(failure(self.settings[1],key)):
+                    """False Hit Failure"""
+                    break
+            else:
+                """If not found in cache, raise KeyError."""
+                self.misses+=1
+                raise KeyError(key)
+        self.hits+=1
+        if self.capacity:
+            self.touch(line)
+        self.use(line)
+        return self.cache[line][1]
     def remove(self,key):
         """Remove a key from cache, if present."""
         hk=self.hash(key)
-        if hk in self.cache.keys():
-            del cache[hk]
+        if(self.ways>1):
+            for line in self.lines(hk):
+                if(line in self.cache and self.cache[line][0]==key):
+                    self.drop(line)
+        elif hk in self.cache.keys():
+            self.drop(hk)
+
+class ConcurrentCache(Cache):
+    """Noisy Cache that several threads can use at once.
+       Each operation holds the stripe lock of the slot it uses, so a
+       half-write or hit sees one consistent entry. The bookkeeping shared
+       by all slots is only changed while holding the structure lock, which
+       is always taken after any stripe lock. Eviction passes by entries
+       whose slot another thread is using.
+    """
+    def __init__(self, s=(16,0.0001,0.0001,0.0001,0.0001), stripes=LOCK_STRIPES):
+        """Initialize with list of cache settings, as for Cache."""
+        self.locks=[threading.RLock() for i in range(stripes)]
+        self.structure=threading.RLock()
+        super().__init__(s)
+        self.hits=AtomicCounter()
+        self.misses=AtomicCounter()
+        self.evictions=AtomicCounter()
+        self.conflicts=AtomicCounter()
+    def slotLock(self,line):
+        """Return the stripe lock for the slot of line."""
+        if isinstance(line,tuple):
+            line=line[0]
+        return stripeLock(self.locks, line)
+    @contextlib.contextmanager
+    def everything(self):
+        """Hold every lock, in order."""
+        with contextlib.ExitStack() as stack:
+            for lock in self.locks:
+                stack.enter_context(lock)
+            stack.enter_context(self.structure)
+            yield
+    def config(self, s):
+        """Update cache settings, as for Cache."""
+        with self.everything():
+            super().config(s)
+    def clear(self):
+        """Empty the cache."""
+        with self.everything():
+            super().clear()
+    def stats(self):
+        """Return the counts and hit rate, as for Cache."""
+        with self.structure:
+            stats={"hits": int(self.hits), "misses": int(self.misses),
+                   "evictions": int(self.evictions),
+                   "conflicts": int(self.conflicts),
+                   "entries": len(self.cache)}
+        n=stats["hits"]+stats["misses"]
+        stats["rate"]=stats["hits"]/n if n else 0.0
+        return stats
+    def touch(self,hk):
+        with self.structure:
+            super().touch(hk)
+    def drop(self,hk):
+        with self.structure:
+            super().drop(hk)
+    def use(self,line):
+        with self.structure:
+            super().use(line)
+    def insert(self,line,entry):
+        with self.structure:
+            super().insert(line,entry)
+    def randomEntry(self):
+        with self.structure:
+            return super().randomEntry()
+    def hash(self,key):
+        with self.structure:
+            return super().hash(key)
+    def evict(self):
+        """Remove one entry from the cache, chosen by the eviction policy.
+           If another thread is using its slot, the next entry in eviction
+           order is removed instead. If every entry is in use, nothing is
+           removed, and the cache is over capacity until the next eviction.
+        """
+        with self.structure:
+            first=self.victim()
+            rest=self.order if self.policy=="RANDOM" else self.cache
+            for line in itertools.chain((first,),rest):
+                lock=self.slotLock(line)
+                if lock.acquire(blocking=False):
+                    break
+            else:
+                return
+            try:
+                self.drop(line)
+                self.evictions+=1
+            finally:
+                lock.release()
+    def store(self,key,val):
+        """Store the key-value pair in the cache."""
+        with self.slotLock(self.hash(key)):
+            super().store(key,val)
+    def fetch(self,key):
+        """Retrieve a cached value, as for Cache."""
+        with self.slotLock(self.hash(key)):
+            return super().fetch(key)
+    def remove(self,key):
+        """Remove a key from cache, if present."""
+        with self.slotLock(self.hash(key)):
+            super().remove(key)
+
+def replaceFile(name, write, mode='wb'):
+    """Call write with a new file opened in mode, then atomically replace
+       the file name with it once it is safely on disk.
+    """
+    of=open(name+".tmp", mode)
+    write(of)
+    of.flush()
+    os.fsync(of.fileno())
+    of.close()
+    os.replace(name+".tmp", name)
+
+def writeHistory(history, of):
+    """Write the configuration history to the open text file of."""
+    for (op,s) in history:
+         of.write("CONF\t{}\t{}\n".format(s,op))
+
+def writeText(items, history, of):
+    """Write the human-readable dump of the configuration history and
+       the (key, value) pairs from items to the open text file of.
+    """
+    of.write("Crusher ver 0.92\n")
+    writeHistory(history, of)
+    for (k,v) in items:
+         of.write("{}\t{}\n".format(str(k),str(v)))
+
+def exportText(db, history=None, filename=None):
+    """Write the human-readable text dump of database db. If history is
+       None, it is read from the history saved with the database.
+    """
+    if(filename==None):
+        filename=db.filename
+    filename=os.path.splitext(filename)[0]
+    if(history==None):
+        history=[]
+        try:
+            with open(filename+"-db.hist", 'r') as f:
+                for line in f:
+                    line=line[:-1].split("\t")
+                    history.append((line[2],line[1]))
+        except FileNotFoundError:
+            """No history was saved."""
+    replaceFile(filename+"-db.txt", lambda of: writeText(db.items(), history, of), 'w')
+
+def writeSnapshot(items, of):
+    """Write the (key, value) pairs from items to the open binary file of
+       as an indexed snapshot.
+    """
+    of.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC,0,0,0))
+    pos=SNAPSHOT_HEADER.size
+    index=[]
+    for (key,val) in items:
+        k=pickle.dumps(key, pickle.HIGHEST_PROTOCOL)
+        v=pickle.dumps(val, pickle.HIGHEST_PROTOCOL)
+        of.write(SNAPSHOT_RECORD.pack(len(k),len(v)))
+        of.write(k)
+        of.write(v)
+        index.append((keyHash(key),pos))
+        pos+=SNAPSHOT_RECORD.size+len(k)+len(v)
+    """Build an open-addressed table at most half full, so probes are
+       short.
+    """
+    slots=8
+    while slots<2*len(index):
+        slots*=2
+    table=array.array("Q", bytes(16*slots))
+    for (h,off) in index:
+        i=h&(slots-1)
+        while table[2*i+1]!=0:
+            i=(i+1)&(slots-1)
+        table[2*i]=h
+        table[2*i+1]=off
+    if sys.byteorder!="little":
+        table.byteswap()
+    of.write(table.tobytes())
+    of.seek(0)
+    of.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC,len(index),slots,pos))
+    of.seek(0,2)
+
+class SnapshotDict(collections.abc.MutableMapping):
+    """A dictionary backed by a memory-mapped indexed snapshot.
+       Only the header is read when it is opened. Values are decoded the
+       first time they are fetched, and changes are kept in memory until
+       the next snapshot is written.
+    """
+    def __init__(self, f):
+        """Map the indexed snapshot in the open binary file f."""
+        self.map=mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic,self.count,self.slots,self.index)=SNAPSHOT_HEADER.unpack_from(self.map,0)
+        """Entries that have been changed or already decoded."""
+        self.overlay={}
+        """Entries in the snapshot that have since been removed."""
+        self.deleted=set()
+    def find(self,key):
+        """Return the offset of the record for key in the snapshot,
+           or 0 if it is not in the snapshot.
+        """
+        if self.count==0:
+            return 0
+        h=keyHash(key)
+        mask=self.slots-1
+        i=h&mask
+        while True:
+            (sh,off)=SNAPSHOT_SLOT.unpack_from(self.map,self.index+16*i)
+            if off==0:
+                return 0
+            if sh==h and self.record(off)[0]==key:
+                return off
+            i=(i+1)&mask
+    def record(self,off,decodeValue=False):
+        """Return (key, offset of value, length of value) for the record at
+           off, or (key, value) if decodeValue is True.
+        """
+        (kl,vl)=SNAPSHOT_RECORD.unpack_from(self.map,off)
+        off+=SNAPSHOT_RECORD.size
+        key=pickle.loads(self.map[off:off+kl])
+        if decodeValue:
+            return (key, pickle.loads(self.map[off+kl:off+kl+vl]))
+        return (key, off+kl, vl)
+    def records(self):
+        """Iterate over the (key, value offset, value length) of every
+           record in the snapshot, in the order they were written.
+        """
+        off=SNAPSHOT_HEADER.size
+        for i in range(self.count):
+            rec=self.record(off)
+            yield rec
+            off=rec[1]+rec[2]
+    def __getitem__(self,key):
+        try:
+            return self.overlay[key]
+        except KeyError:
+            """Not decoded yet, so look in the snapshot."""
+        if key in self.deleted:
+            raise KeyError(key)
+        off=self.find(key)
+        if off==0:
+            raise KeyError(key)
+        val=self.record(off,True)[1]
+        self.overlay[key]=val
+        return val
+    def __setitem__(self,key,val):
+        self.overlay[key]=val
+        self.deleted.discard(key)
+    def __delitem__(self,key):
+        if key in self.overlay:
+            del self.overlay[key]
+            if key not in self.deleted and self.find(key)!=0:
+                self.deleted.add(key)
+        elif key not in self.deleted and self.find(key)!=0:
+            self.deleted.add(key)
+        else:
+            raise KeyError(key)
+    def __contains__(self,key):
+        if key in self.overlay:
+            return True
+        return key not in self.deleted and self.find(key)!=0
+    def __iter__(self):
+        """Iterate over the changed keys, then the rest of the snapshot."""
+        yield from self.overlay
+        for (k,off,vl) in self.records():
+            if k not in self.overlay and k not in self.deleted:
+                yield k
+    def __len__(self):
+        """Count the keys. This scans the snapshot."""
+        return sum(1 for k in self)
+    def copy(self):
+        """Return a copy that shares the snapshot but not later changes."""
+        ret=SnapshotDict.__new__(SnapshotDict)
+        ret.__dict__.update(self.__dict__)
+        ret.overlay=self.overlay.copy()
+        ret.deleted=self.deleted.copy()
+        return ret
+    def items(self):
+        """Iterate over the (key, value) pairs, without keeping the decoded
+           values in memory.
+        """
+        yield from self.overlay.items()
+        for (k,off,vl) in self.records():
+            if k not in self.overlay and k not in self.deleted:
+                yield (k, pickle.loads(self.map[off:off+vl]))
 
 class DataBase:
-    """In-memory database with persistence on open/close."""
-    def __init__(self, filename="demo.txt"):
-        """Create a database persisted to filename."""
+    """In-memory database with persistence on open/close.
+       In journal mode, every store and remove is also appended to a
+       journal file, which is periodically compacted into the snapshot.
+       In lazy mode, the snapshot is written with an index, and loading
+       maps it into memory instead of reading it.
+       In background mode, snapshots are written by a separate thread from
+       a copy of the database, so the database can keep changing.
+    """
+    def __init__(self, filename="demo.txt", journal=False, compactEvery=100000, lazy=False, background=False, text=True):
+        """Create a database persisted to filename.
+           If journal is True, changes are appended to filename-db.log as
+           they happen, and the journal is compacted into filename-db.dat
+           after every compactEvery records.
+           If lazy is True, snapshots are indexed and values are only read
+           from the snapshot when they are first fetched.
+           If background is True, snapshots are written by another thread.
+           If text is False, saving does not write the human-readable
+           filename-db.txt; it can be written later with export().
+        """
         self.filename=filename
+        self.journal=None
+        self.compactEvery=compactEvery
+        self.lazy=lazy
+        self.background=background
+        self.text=text
+        self.saver=None
         self.load()
+        if journal:
+            self.openJournal()
     def store(self,key,val):
         """Store a key-value pair in the database."""
         self.cache[key]=val
+        if(self.journal!=None):
+            self.append(JOURNAL_STORE,key,val)
+    def store_many(self,keys,vals):
+        """Store each key with the corresponding value in the database."""
+        if(self.journal!=None):
+            for (k,v) in zip(keys,vals):
+                self.store(k,v)
+        else:
+            self.cache.update(zip(keys,vals))
     def fetch(self,key):
         """Fetch the value associate with a key in the database."""
         return self.cache[key]
@@ -145,36 +900,373 @@ class DataBase:
            Returns the value that was in the database.
            Raises a KeyError if the key is not in the database.
         """
-        if key in cache:
-            ret=cache[key]
-            del cache[key]
+        if key in self.cache:
+            ret=self.cache[key]
+            del self.cache[key]
+            if(self.journal!=None):
+                self.append(JOURNAL_REMOVE,key,None)
             return ret
         else:
             raise KeyError(key)
     def save(self,history,filename=None):
-        """Save the contents of the database into a file."""
+        """Save the contents of the database into a file.
+           In journal mode, the journal already holds every change, so saving
+           to the database's own file only needs to make sure the journal
+           is on disk.
+           Each file is written under a temporary name and then renamed, so
+           a crash while saving leaves the previous save intact.
+        """
+        history=list(history)
         if(filename==None):
             filename=self.filename
+            if(self.journal!=None):
+                os.fsync(self.journal.fileno())
+                name=os.path.splitext(filename)[0]
+                replaceFile(name+"-db.hist", lambda of: writeHistory(history, of), 'w')
+                return
         filename=os.path.splitext(filename)[0]
-        of=open(filename+"-db.dat", 'wb')
-        pickle.dump(self.cache, of)
-        of.close()
-        of=open(filename+"-db.txt", 'w')
-        of.write("Crusher ver 0.92\n")
-        for (op,s) in history:
-             of.write("CONF\t{}\t{}\n".format(s,op))
-        for (k,v) in self.cache.items():
-             of.write("{}\t{}\n".format(str(k),str(v)))
-        of.close()
+        self.wait()
+        self.start(self.writeFiles, self.view(), history, filename)
+    def writeFiles(self,cache,history,filename):
+        """Write the snapshot of cache, and either the text dump or just
+           the history, for filename.
+        """
+        replaceFile(filename+"-db.dat", lambda of: self.dump(cache, of))
+        if self.text:
+            replaceFile(filename+"-db.txt", lambda of: writeText(cache.items(), history, of), 'w')
+        else:
+            replaceFile(filename+"-db.hist", lambda of: writeHistory(history, of), 'w')
+    def export(self,history=None,filename=None):
+        """Write the human-readable text dump of the database.
+           If history is None, it is read from the history saved with the
+           database.
+        """
+        exportText(self,history,filename)
+    def items(self):
+        """Iterate over the (key, value) pairs in the database."""
+        return self.cache.items()
+    def view(self):
+        """Return a copy of the database that will not see later changes.
+           Only needed when the snapshot is written in the background.
+        """
+        if not self.background:
+            return self.cache
+        return self.cache.copy()
+    def start(self,target,*args):
+        """Run target with args, in a new thread in background mode."""
+        if self.background:
+            self.saver=threading.Thread(target=target, args=args)
+            self.saver.start()
+        else:
+            target(*args)
+    def wait(self):
+        """Wait for any snapshot being written in the background."""
+        if(self.saver!=None):
+            self.saver.join()
+            self.saver=None
+    def close(self):
+        """Finish any background work and close the journal."""
+        self.wait()
+        if(self.journal!=None):
+            self.journal.close()
+            self.journal=None
     def load(self,filename=()):
-        """Load the contents of the database into a file."""
+        """Load the contents of the database into a file.
+           Any changes recorded in the journals after the snapshot are
+           replayed on top of it.
+        """
         if(len(filename)==0):
             filename=self.filename
         filename=os.path.splitext(filename)[0]
         try:
-            self.cache=pickle.load(open(filename+"-db.dat", 'rb'))
+            with open(filename+"-db.dat", 'rb') as f:
+                if f.read(len(SNAPSHOT_MAGIC))==SNAPSHOT_MAGIC:
+                    """Indexed snapshot: map it, and only read all of it
+                       now if we are not in lazy mode.
+                    """
+                    self.cache=SnapshotDict(f)
+                    if not self.lazy:
+                        self.cache=dict(self.cache.items())
+                else:
+                    f.seek(0)
+                    self.cache=pickle.load(f)
         except FileNotFoundError:
             self.cache={}
+        self.replay(filename+"-db.log.old")
+        self.replay(filename+"-db.log")
+    def dump(self,cache,of):
+        """Write a snapshot of cache to the open binary file of."""
+        if self.lazy:
+            writeSnapshot(cache.items(), of)
+        else:
+            pickle.dump(cache, of)
+    def openJournal(self):
+        """Start appending changes to the journal."""
+        name=os.path.splitext(self.filename)[0]+"-db.log"
+        """Unbuffered, so that each record reaches the OS as it is written
+           and survives the process crashing.
+        """
+        self.journal=open(name, 'ab', buffering=0)
+        self.records=0
+    def append(self,op,key,val):
+        """Append a single change to the journal.
+           Each record is a header with the operation and the lengths of the
+           pickled key and value, followed by the pickles.
+        """
+        k=pickle.dumps(key, pickle.HIGHEST_PROTOCOL)
+        v=b"" if op==JOURNAL_REMOVE else pickle.dumps(val, pickle.HIGHEST_PROTOCOL)
+        self.journal.write(JOURNAL_HEADER.pack(op,len(k),len(v))+k+v)
+        self.records+=1
+        if(self.records>=self.compactEvery):
+            self.compact()
+        elif(self.lazy and self.saver!=None and not self.saver.is_alive()):
+            """A compaction finished in the background."""
+            self.wait()
+            self.remap()
+    def replay(self,name):
+        """Apply the changes recorded in the journal name to the cache.
+           A partially written record at the end of the journal, left by a
+           crash, is discarded.
+        """
+        try:
+            f=open(name, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            data=f.read()
+        pos=0
+        size=JOURNAL_HEADER.size
+        while pos+size<=len(data):
+            (op,kl,vl)=JOURNAL_HEADER.unpack_from(data,pos)
+            end=pos+size+kl+vl
+            if(end>len(data)):
+                break
+            key=pickle.loads(data[pos+size:pos+size+kl])
+            if(op==JOURNAL_STORE):
+                self.cache[key]=pickle.loads(data[pos+size+kl:end])
+            else:
+                self.cache.pop(key,None)
+            pos=end
+        if(pos<len(data)):
+            """Drop the torn record so that new records follow good ones."""
+            with open(name, 'r+b') as f:
+                f.truncate(pos)
+    def compact(self):
+        """Write a new snapshot and start a new, empty journal.
+           The current journal is set aside as filename-db.log.old until the
+           new snapshot has been renamed into place, so a crash during
+           compaction leaves a snapshot and journals that load correctly.
+           Replaying a journal on top of a snapshot that already includes
+           it gives the same result.
+           In lazy mode, the new snapshot is mapped once it is written.
+        """
+        self.wait()
+        name=os.path.splitext(self.filename)[0]
+        self.journal.close()
+        if os.path.exists(name+"-db.log.old"):
+            """A crash during the last compaction left its journal, which
+               no snapshot includes yet, so this journal follows it.
+            """
+            with open(name+"-db.log.old", 'ab') as of:
+                with open(name+"-db.log", 'rb') as f:
+                    of.write(f.read())
+            os.remove(name+"-db.log")
+        else:
+            os.replace(name+"-db.log", name+"-db.log.old")
+        self.journal=open(name+"-db.log", 'wb', buffering=0)
+        self.records=0
+        self.start(self.writeCompacted, self.view(), name)
+        if self.lazy and not self.background:
+            self.remap()
+    def remap(self):
+        """Map the snapshot written by the last compaction instead of
+           keeping the changes it holds in memory. The changes made since
+           it started are all in the new journal, so they are replayed on
+           top of it.
+        """
+        name=os.path.splitext(self.filename)[0]
+        with open(name+"-db.dat", 'rb') as f:
+            self.cache=SnapshotDict(f)
+        self.replay(name+"-db.log")
+    def writeCompacted(self,cache,name):
+        """Write the snapshot of cache for a compaction, then discard the
+           journal that it replaces.
+        """
+        replaceFile(name+"-db.dat", lambda of: self.dump(cache, of))
+        os.remove(name+"-db.log.old")
+
+class SQLiteDataBase:
+    """Database stored in a local SQLite file, so it does not have to fit
+       in memory. Keys and values are pickled.
+       Writes are grouped into transactions of up to batch writes.
+    """
+    def __init__(self, filename="demo.txt", batch=1000, text=False):
+        """Create a database stored in filename-db.sqlite.
+           If text is True, saving also writes the human-readable
+           filename-db.txt. Otherwise it can be written later with export().
+        """
+        self.filename=filename
+        self.batch=batch
+        self.text=text
+        self.load()
+    def encode(self,key):
+        """Return the stored form of key: its pickle, without the memo, so
+           that equal keys are pickled the same whether or not they share
+           objects.
+        """
+        f=io.BytesIO()
+        p=pickle.Pickler(f, SQL_KEY_PROTOCOL)
+        p.fast=True
+        p.dump(key)
+        return f.getvalue()
+    def store(self,key,val):
+        """Store a key-value pair in the database."""
+        self.write(SQL_STORE,(self.encode(key),pickle.dumps(val, pickle.HIGHEST_PROTOCOL)))
+    def store_many(self,keys,vals):
+        """Store each key with the corresponding value in the database."""
+        for (k,v) in zip(keys,vals):
+            self.store(k,v)
+    def fetch(self,key):
+        """Fetch the value associate with a key in the database."""
+        row=self.conn.execute(SQL_FETCH,(self.encode(key),)).fetchone()
+        if(row==None):
+            raise KeyError(key)
+        return pickle.loads(row[0])
+    def remove(self,key):
+        """Remove the key and its value from the database.
+           Returns the value that was in the database.
+           Raises a KeyError if the key is not in the database.
+        """
+        ret=self.fetch(key)
+        self.write(SQL_REMOVE,(self.encode(key),))
+        return ret
+    def write(self,sql,args):
+        """Run a statement that changes the database, starting a new
+           transaction if needed and committing after batch writes.
+        """
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+        self.conn.execute(sql,args)
+        self.writes+=1
+        if(self.writes>=self.batch):
+            self.commit()
+    def commit(self):
+        """Commit the current transaction, if any."""
+        if self.conn.in_transaction:
+            self.conn.execute("COMMIT")
+        self.writes=0
+    def items(self):
+        """Iterate over the (key, value) pairs in the database."""
+        for (k,v) in self.conn.execute(SQL_ITEMS):
+            yield (pickle.loads(k), pickle.loads(v))
+    def save(self,history,filename=None):
+        """Commit the database, and save the history and the text dump.
+           If filename is given, the database is also copied to it.
+        """
+        self.commit()
+        if(filename==None):
+            filename=self.filename
+        elif(filename!=self.filename):
+            dest=sqlite3.connect(os.path.splitext(filename)[0]+"-db.sqlite")
+            self.conn.backup(dest)
+            dest.close()
+        filename=os.path.splitext(filename)[0]
+        history=list(history)
+        if self.text:
+            replaceFile(filename+"-db.txt", lambda of: writeText(self.items(), history, of), 'w')
+        else:
+            replaceFile(filename+"-db.hist", lambda of: writeHistory(history, of), 'w')
+    def export(self,history=None,filename=None):
+        """Write the human-readable text dump of the database.
+           If history is None, it is read from the history saved with the
+           database.
+        """
+        exportText(self,history,filename)
+    def load(self,filename=()):
+        """Open the database file."""
+        if(len(filename)==0):
+            filename=self.filename
+        filename=os.path.splitext(filename)[0]
+        """Transactions are managed explicitly, in batches. The connection
+           may be used from other threads, as long as only one uses it at a
+           time, as ConcurrentDataBase makes sure of.
+        """
+        self.conn=sqlite3.connect(filename+"-db.sqlite", isolation_level=None,
+                                  check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(SQL_CREATE)
+        self.writes=0
+    def close(self):
+        """Commit and close the database file."""
+        self.commit()
+        self.conn.close()
+
+"""Storage engines that a Broker can use, by name. Each is called with the
+   filename to persist to. None of them write the text dump when they save;
+   crusher.py export writes it.
+"""
+storages={
+    "memory": lambda filename: DataBase(filename, text=False),
+    "journal": lambda filename: DataBase(filename, journal=True, lazy=True, background=True, text=False),
+    "sqlite": SQLiteDataBase,
+}
+
+class ConcurrentDataBase:
+    """Wrapper that lets several threads use a database at once.
+       Operations on a key hold the stripe lock for that key. That is
+       enough for an in-memory DataBase, where each change is a single dict
+       operation. A journal or an SQLite connection is shared by every key,
+       so for those every operation holds one lock. Operations on the whole
+       database hold every lock.
+    """
+    def __init__(self, db, stripes=LOCK_STRIPES):
+        """Wrap db."""
+        self.db=db
+        if(isinstance(db,DataBase) and db.journal==None):
+            self.locks=[threading.Lock() for i in range(stripes)]
+        else:
+            self.locks=[threading.Lock()]
+    def __getattr__(self, name):
+        """Anything else is the wrapped database's."""
+        return getattr(self.db, name)
+    @contextlib.contextmanager
+    def everything(self):
+        """Hold every lock, in order."""
+        with contextlib.ExitStack() as stack:
+            for lock in self.locks:
+                stack.enter_context(lock)
+            yield
+    def store(self,key,val):
+        """Store a key-value pair in the database."""
+        with stripeLock(self.locks, key):
+            self.db.store(key,val)
+    def store_many(self,keys,vals):
+        """Store each key with the corresponding value in the database."""
+        with self.everything():
+            self.db.store_many(keys,vals)
+    def fetch(self,key):
+        """Fetch the value associate with a key in the database."""
+        with stripeLock(self.locks, key):
+            return self.db.fetch(key)
+    def remove(self,key):
+        """Remove the key and its value from the database, as for the
+           wrapped database.
+        """
+        with stripeLock(self.locks, key):
+            return self.db.remove(key)
+    def save(self,history,filename=None):
+        """Save the contents of the database, as for the wrapped database."""
+        with self.everything():
+            self.db.save(history,filename)
+    def items(self):
+        """Return a list of the (key, value) pairs in the database."""
+        with self.everything():
+            return list(self.db.items())
+    def close(self):
+        """Close the wrapped database."""
+        with self.everything():
+            self.db.close()
 
 class Channel:
     """Noisy Channel implementation."""
@@ -182,9 +1274,27 @@ class Channel:
         """Create a noisy channel with the specified settings."""
         self.hasPrev=False
         self.settings=s
+        self.plan()
     def config(self, s):
         """Change the settings of the noisy channel."""
         self.settings=s
+        self.plan()
+    def isNoisy(self):
+        """Return whether the channel can change data. Scramble failures
+           alone cannot, since scrambling is not implemented.
+        """
+        return self.settings[0]>0 or self.settings[1]>0
+    def plan(self):
+        """Skip the failure draws in mangle while the channel cannot change
+           data. The previous data for Clone failures is forgotten when the
+           channel becomes noisy again.
+        """
+        if self.isNoisy():
+            if "mangle" in self.__dict__:
+                del self.mangle
+                self.hasPrev=False
+        else:
+            self.mangle=freeze
     def mangle(self, data):
         """Return the data, with some bits possibly changed."""
         if(self.hasPrev and failure(self.settings[1],data)):
@@ -197,104 +1307,156 @@ class Channel:
             return self.scramble(data)
         """Bit flip faliure"""
         return self.bitflip(data)
+    def mangle_many(self, items):
+        """Return a list of the items, each passed through mangle in order.
+           The failures are the same as mangling the items one at a time.
+        """
+        mangle=self.mangle
+        return [mangle(data) for data in items]
     def scramble(self, data):
         """Return the data with the bits scrambled.
            TODO: Scramble is not impleented.
         """
         return data
     def bitflip(self, data):
-        """Possibly flip bits in data based on the failure rate."""
-        try:
-            """Try processing as a character."""
-            c=ord(data)
-            n=math.ceil(math.log2(c+1))+1 
-            for i in range(failures(self.settings[0],n)):
-                c=c^(2**random.randrange(n))
-            return chr(c)
-        except TypeError:
-            """Do nothing"""
-        try:
-            """Try processing as a string."""
-            return "".join(chr(self.bitflip(ord(c))) for c in data)
-        except TypeError:
-            """Do nothing"""
-        try:
-            """Try processing as a number."""
-            if data<0:
-                """If data is negative, return the positive version if
-                   the sign bit is flipped.
-                """
-                data=self.bitflip(-data)
-                if(failure(self.settings[0],1)):
-                    return data
-                else:
-                    return -data
-            n=math.ceil(math.log2(data+1))+1 
-            try:
-                """If the number is like an integer, possibly flip bits
-                   starting with the leading 0.
-                """
-                for i in range(failures(self.settings[0],n)):
-                    data=data^(2**random.randrange(n))
-            except KeyError:
-                """If the number is like a float, flip any of the first 24
-                   bits.
-                """
-                for i in range(failures(self.settings[0],24)):
-                    bit=2**(n-random.randrange(n))
-                    val=math.floor(data/bit)
-                    if val==math.floor(0.5*val)*2:
-                        """Bit is not set."""
-                        data=data+bit
-                    else:
-                        data=data-bit
+        """Possibly flip bits in data based on the failure rate.
+           Characters and non-negative integers can have any bit flipped,
+           up to and including the leading 0. Negative numbers can also
+           lose their sign. Tuples and lists have their items flipped, and
+           lists are returned as tuples. Bytes can have
+           any of their 8 bits flipped. Data that cannot be mangled is
+           returned as-is.
+           The number of flips for all of data is drawn at once from its
+           total number of bits, which gives the same failures as drawing
+           them bit by bit. Data is returned untouched if nothing flips.
+        """
+        data=freeze(data)
+        rate=self.settings[0]
+        if(rate<=0):
             return data
-        except TypeError:
-            """Do nothing."""
-        try:
-            """If data is iterable, return a tuple of bitflipped items."""
-            return tuple(self.bitflip(x) for x in data)
-        except TypeError:
-            """If we cannot figure out how to mangle, just return it as-is."""
+        n=bitUnits(data)
+        if(n==0):
             return data
+        k=failures(rate,n)
+        if(k==0):
+            return data
+        return flipBits(data, sorted(random.randrange(n) for i in range(k)))
+
+class LocalChannel(Channel):
+    """Noisy Channel that several threads can use at once. The previous
+       data used for Clone failures is kept separately for each thread, so
+       one thread never receives data cloned from another. Forgetting the
+       previous data forgets it for every thread.
+    """
+    def __init__(self, s=(0.0001, 0.0001, 0.0001)):
+        """Create a noisy channel with the specified settings."""
+        self.local=threading.local()
+        self.generation=0
+        super().__init__(s)
+    @property
+    def hasPrev(self):
+        """Whether this thread has passed data since it was last forgotten."""
+        return getattr(self.local,"generation",None)==self.generation
+    @hasPrev.setter
+    def hasPrev(self, has):
+        if has:
+            self.local.generation=self.generation
+        else:
+            self.generation+=1
+    @property
+    def prev(self):
+        """The data this thread last passed."""
+        return self.local.prev
+    @prev.setter
+    def prev(self, data):
+        self.local.prev=data
 
 class Broker:
     """Broker implements a noisy hash database, with configurable failure
        rates.
+       In concurrent mode, several threads can use the broker at once.
+       The cache and database use striped locks, each thread has its own
+       Clone failure state in the channels, and incr is atomic.
     """
-    def __init__(self, filename="demo.txt"):
-        """Create a broker with default settings that persist to filename."""
+    def __init__(self, filename="demo.txt", db=None, concurrent=False):
+        """Create a broker with default settings that persist to filename.
+           If db is given, it is used as the database instead of a
+           DataBase persisted to filename.
+           If concurrent is True, the broker can be used by several threads.
+        """
         random.seed()
         self.history=[(0,"defaults")]
-        self.ops=0
-        self.cache=Cache()
-        self.db=DataBase(filename)
-        self.keyIn=Channel()
-        self.valIn=Channel()
-        self.keyCache=Channel()
-        self.valCacheOut=Channel()
-        self.valCacheIn=Channel()
-        self.keyDB=Channel()
-        self.valDBOut=Channel()
-        self.valDBIn=Channel()
+        self.configuring=threading.Lock()
+        if(db==None):
+            db=DataBase(filename)
+        if concurrent:
+            self.ops=AtomicCounter()
+            self.cache=ConcurrentCache()
+            self.db=ConcurrentDataBase(db)
+            self.locks=[threading.RLock() for i in range(LOCK_STRIPES)]
+            """incr has its own locks, so it can be called while holding
+               a lock from lock without any risk of deadlock.
+            """
+            self.counterLocks=[threading.Lock() for i in range(LOCK_STRIPES)]
+            channel=LocalChannel
+        else:
+            self.ops=0
+            self.cache=Cache()
+            self.db=db
+            self.locks=None
+            self.counterLocks=None
+            channel=Channel
+        self.keyIn=channel()
+        self.valIn=channel()
+        self.keyCache=channel()
+        self.valCacheOut=channel()
+        self.valCacheIn=channel()
+        self.keyDB=channel()
+        self.valDBOut=channel()
+        self.valDBIn=channel()
         self.configurables=(self.cache, self.keyIn, self.valIn, self.keyCache, self.valCacheIn, self.valCacheOut, self.keyDB, self.valDBIn, self.valDBOut)
+        self.direct=False
+        self.plan()
         self.doExit=False
         signal.signal(signal.SIGINT, self.interrupt)
     def configure(self,s):
         """Process configuration message s."""
-        self.history.append((self.ops,s))
-        s=ast.literal_eval(s)
-        try:
-            for c in s[0]:
-                self.configurables[c].config(s[1:])
-        except TypeError:
-            self.configurables[s[0]].config(s[1:])
+        with self.configuring:
+            self.history.append((int(self.ops),s))
+            s=ast.literal_eval(s)
+            try:
+                for c in s[0]:
+                    self.configurables[c].config(s[1:])
+            except TypeError:
+                self.configurables[s[0]].config(s[1:])
+            self.plan()
+    def plan(self):
+        """Decide how operations are carried out with the current settings.
+           Quiet channels skip themselves. If nothing can fail, operations
+           go straight to the database, and the cache is emptied when
+           failures are turned back on, since it missed the changes.
+        """
+        direct=not any(c.isNoisy() for c in self.configurables)
+        if(self.direct and not direct):
+            self.cache.clear()
+        self.direct=direct
     def interrupt(self, signal, frame):
         """Flag that an interrupt was received and we should exit ASAP."""
         self.doExit=True
+    def lock(self,key):
+        """Return a lock to hold while a series of operations on key must
+           not be interleaved with other threads' operations on it.
+           Outside concurrent mode, there is nothing to lock.
+        """
+        if(self.locks==None):
+            return contextlib.nullcontext()
+        return stripeLock(self.locks, freeze(key))
     def store(self,key,val):
         """Store a key-value pair in the database."""
         self.ops+=1
+        if self.direct:
+            self.db.store(freeze(key),freeze(val))
+            return
         key=self.keyIn.mangle(key)
         val=self.valIn.mangle(val)
         self.cache.store(self.keyCache.mangle(key),self.valCacheOut.mangle(val))
@@ -305,6 +1467,8 @@ class Broker:
            Raise a KeyError if the key is not in the database.
         """
         self.ops+=1
+        if self.direct:
+            return self.db.fetch(freeze(key))
         key=self.keyIn.mangle(key)
         try:
             """Return the value from cache if the key is in the cache."""
@@ -312,20 +1476,353 @@ class Broker:
         except KeyError:
             """Return the value from the database if the key is in the DB."""
             return self.valDBIn.mangle(self.db.fetch(self.keyDB.mangle(key)))
+    def incr(self,key,item,when=None,by=1):
+        """Increment the counter stored under key in a single operation.
+           The value is a (item, count, when) tuple, and is replaced by
+           (item, count+by, when); a count of None acts as 0. The item is
+           the one passed in, not the one read, so a damaged item is
+           repaired rather than written back.
+           The value is read and written back through the same channels as
+           a fetch and a store. Return the new value.
+           Raise a KeyError if the key is not in the database.
+           In concurrent mode, no other thread increments the key meanwhile.
+        """
+        if(self.counterLocks==None):
+            return self.increment(key,item,when,by)
+        with stripeLock(self.counterLocks, freeze(key)):
+            return self.increment(key,item,when,by)
+    def increment(self,key,item,when,by):
+        """Increment the counter stored under key, for incr."""
+        self.ops+=1
+        if self.direct:
+            key=freeze(key)
+            v=self.db.fetch(key)
+            v=(freeze(item), by if v[1]==None else v[1]+by, freeze(when))
+            self.db.store(key,v)
+            return v
+        key=self.keyIn.mangle(key)
+        item=self.valIn.mangle(item)
+        when=self.valIn.mangle(when)
+        try:
+            """Read the value from cache if the key is in the cache."""
+            v=self.valCacheIn.mangle(self.cache.fetch(self.keyCache.mangle(key)))
+        except KeyError:
+            """Read the value from the database if the key is in the DB."""
+            v=self.valDBIn.mangle(self.db.fetch(self.keyDB.mangle(key)))
+        v=(item, by if v[1]==None else v[1]+by, when)
+        self.cache.store(self.keyCache.mangle(key),self.valCacheOut.mangle(v))
+        self.db.store(self.keyDB.mangle(key),self.valDBOut.mangle(v))
+        return v
+    def store_many(self,items):
+        """Store a batch of (key, value) pairs in the database.
+           Each pair suffers the same failures as a separate store, but the
+           batch passes through each stage of the pipeline in one pass.
+        """
+        items=list(items)
+        self.ops+=len(items)
+        if self.direct:
+            self.db.store_many([freeze(k) for (k,v) in items],
+                               [freeze(v) for (k,v) in items])
+            return
+        keys=self.keyIn.mangle_many(k for (k,v) in items)
+        vals=self.valIn.mangle_many(v for (k,v) in items)
+        cstore=self.cache.store
+        for (k,v) in zip(self.keyCache.mangle_many(keys),
+                         self.valCacheOut.mangle_many(vals)):
+            cstore(k,v)
+        self.db.store_many(self.keyDB.mangle_many(keys),
+                           self.valDBOut.mangle_many(vals))
+    def fetch_many(self,keys,default=None):
+        """Fetch the values of a batch of keys from the database.
+           Return a list of the values, in the same order as keys, with
+           default in place of any key that is not in the database.
+        """
+        keys=self.keyIn.mangle_many(keys)
+        self.ops+=len(keys)
+        ret=[default]*len(keys)
+        if self.direct:
+            dfetch=self.db.fetch
+            for (i,k) in enumerate(keys):
+                try:
+                    ret[i]=dfetch(k)
+                except KeyError:
+                    """Leave the default in place for keys not in the DB."""
+            return ret
+        cfetch=self.cache.fetch
+        hits=[]
+        misses=[]
+        for (i,k) in enumerate(self.keyCache.mangle_many(keys)):
+            try:
+                """Remember the value if the key is in the cache."""
+                hits.append((i,cfetch(k)))
+            except KeyError:
+                """Otherwise, look for the key in the database."""
+                misses.append(i)
+        for ((i,v),m) in zip(hits,self.valCacheIn.mangle_many(v for (i,v) in hits)):
+            ret[i]=m
+        dfetch=self.db.fetch
+        found=[]
+        for (i,k) in zip(misses,self.keyDB.mangle_many(keys[i] for i in misses)):
+            try:
+                found.append((i,dfetch(k)))
+            except KeyError:
+                """Leave the default in place for keys not in the DB."""
+        for ((i,v),m) in zip(found,self.valDBIn.mangle_many(v for (i,v) in found)):
+            ret[i]=m
+        return ret
     def remove(self,key):
         """Remove the key from cache and database. Return the old value from
            the database.
            Raises KeyError if the key was not in the database.
         """
         self.ops+=1
+        if self.direct:
+            return self.db.remove(freeze(key))
         self.cache.remove(self.keyCache.mangle(key))
         return self.valDBIn.mangle(self.db.remove(self.keyDB.mangle(key)))
     def exit(self):
         """Persist the database in preparation to exit."""
         self.db.save(self.history)
+        self.db.close()
+        print("Cache: {hits} hits, {misses} misses ({rate:.1%} hit rate), {evictions} evictions, {conflicts} conflicts, {entries} entries".format(**self.cache.stats()))
         print("Goodbye!")
 
+def effectiveConfiguration(messages):
+    """Return the configuration messages, in order, that a new Broker must
+       process to end up configured as after all of messages. A message is
+       left out once later messages have replaced all of its settings: a
+       channel's settings are replaced by any later message for it, and
+       the cache's by a later message with at least as many settings.
+    """
+    parsed=[]
+    for s in messages:
+        m=ast.literal_eval(s)
+        try:
+            targets=set(m[0])
+        except TypeError:
+            targets={m[0]}
+        parsed.append((s, targets, len(m)-1))
+    kept=[]
+    for (s, targets, n) in reversed(parsed):
+        """Walk back from the newest, keeping what is not yet replaced."""
+        live={c for c in targets
+              if not any(c in t and (c!=0 or m>=n) for (x, t, m) in kept)}
+        if live:
+            kept.append((s, targets, n))
+    return [s for (s, targets, n) in reversed(kept)]
+
+class Missing:
+    """The type of MISSING."""
+    def __reduce__(self):
+        """Pickle as a reference to MISSING, so that it is still MISSING
+           when it is unpickled, even in another process.
+        """
+        return "MISSING"
+    def __repr__(self):
+        return "MISSING"
+
+"""Default that the proxies for a Broker in another process pass to its
+   fetch_many, in place of the caller's. The caller's default is filled in
+   locally, since it may be an object whose identity the caller checks,
+   and that does not survive pickling.
+"""
+MISSING=Missing()
+
+def packedName(key):
+    """Return the dictlist name that the packed key starts with: a length
+       7 bits at a time from the lowest, with the top bit set in every byte
+       but the last, and then that many bytes of name.
+    """
+    (n, shift, i)=(0, 0, 0)
+    while True:
+        b=key[i]
+        i+=1
+        n|=(b&0x7F)<<shift
+        shift+=7
+        if b<0x80:
+            break
+    if i+n>len(key):
+        raise IndexError("packed key is shorter than its name")
+    return key[i:i+n].decode()
+
+def shardName(filename, i):
+    """Return the name that shard i of a ShardedBroker persists to."""
+    return "{}-shard{}".format(filename, i)
+
+def serveShard(conn, filename, storage):
+    """Run the Broker for one shard of a ShardedBroker in this process.
+       Calls arrive on conn as (method, args), and each gets the reply
+       (True, result), or (False, error) if the method raised error.
+    """
+    broker=Broker(filename, storages[storage](filename))
+    """Ctrl-C is handled by the ShardedBroker."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    method=None
+    while method!="exit":
+        (method, args)=conn.recv()
+        try:
+            conn.send((True, getattr(broker,method)(*args)))
+        except Exception as error:
+            conn.send((False, error))
+    conn.close()
+
+class ShardProcess:
+    """ShardProcess runs the Broker for one shard in a separate process, and
+       forwards calls to it through a pipe.
+    """
+    def __init__(self, filename, storage="memory"):
+        """Start a process with a Broker that persists to filename using
+           the named storage from storages.
+        """
+        (self.conn, child)=multiprocessing.Pipe()
+        self.process=multiprocessing.Process(target=serveShard,
+                                             args=(child, filename, storage))
+        self.process.start()
+        child.close()
+    def call(self, method, *args):
+        """Call the method of the Broker, and return its result or raise its
+           error.
+        """
+        self.conn.send((method, args))
+        (ok, result)=self.conn.recv()
+        if not ok:
+            raise result
+        return result
+    def configure(self,s):
+        """Call Broker.configure in the shard process."""
+        self.call("configure",s)
+    def store(self,key,val):
+        """Call Broker.store in the shard process."""
+        self.call("store",key,val)
+    def fetch(self,key):
+        """Call Broker.fetch in the shard process."""
+        return self.call("fetch",key)
+    def incr(self,key,item,when=None,by=1):
+        """Call Broker.incr in the shard process."""
+        return self.call("incr",key,item,when,by)
+    def store_many(self,items):
+        """Call Broker.store_many in the shard process."""
+        self.call("store_many",items)
+    def fetch_many(self,keys,default=None):
+        """Call Broker.fetch_many in the shard process, and fill in default
+           here.
+        """
+        return [default if v is MISSING else v
+                for v in self.call("fetch_many",keys,MISSING)]
+    def remove(self,key):
+        """Call Broker.remove in the shard process."""
+        return self.call("remove",key)
+    def exit(self):
+        """Call Broker.exit in the shard process."""
+        self.call("exit")
+        self.conn.close()
+        self.process.join()
+
+class ShardedBroker:
+    """ShardedBroker spreads keys over several independent Brokers, each
+       with its own cache and its own database persisted to its own files.
+       Keys are routed by a stable hash of their dictlist name, which is
+       the first element of a tuple key, or the name that a packed key
+       starts with, so each CrusherDict lives in a single shard.
+       Configuration changes apply to every shard.
+       If processes is True, each shard runs in its own process.
+    """
+    def __init__(self, filename="demo.txt", shards=4, storage="memory",
+                 processes=False):
+        """Create a broker with shards shards that persist to filename with
+           a shard suffix, using the named storage from storages.
+        """
+        if processes:
+            self.shards=[ShardProcess(shardName(filename,i), storage)
+                         for i in range(shards)]
+        else:
+            self.shards=[Broker(shardName(filename,i),
+                                storages[storage](shardName(filename,i)))
+                         for i in range(shards)]
+        self.ops=0
+        self.doExit=False
+        """Each Broker took over Ctrl-C, so take it back."""
+        signal.signal(signal.SIGINT, self.interrupt)
+    def route(self, key):
+        """Return the index of the shard that holds key."""
+        if isinstance(key,bytes):
+            try:
+                key=packedName(key)
+            except (IndexError, UnicodeDecodeError):
+                """It is not a packed key, so it is routed whole."""
+        elif(isinstance(key,(tuple,list)) and len(key)>0):
+            key=key[0]
+        return zlib.crc32(repr(key).encode())%len(self.shards)
+    def configure(self,s):
+        """Process configuration message s in every shard."""
+        for shard in self.shards:
+            shard.configure(s)
+    def interrupt(self, signal, frame):
+        """Flag that an interrupt was received and we should exit ASAP."""
+        self.doExit=True
+    def store(self,key,val):
+        """Store a key-value pair in the database."""
+        self.ops+=1
+        self.shards[self.route(key)].store(key,val)
+    def fetch(self,key):
+        """Fetch the value for a key from the database.
+           Raises KeyError if the key is not in the database.
+        """
+        self.ops+=1
+        return self.shards[self.route(key)].fetch(key)
+    def incr(self,key,item,when=None,by=1):
+        """Increment the counter stored under key, as Broker.incr does."""
+        self.ops+=1
+        return self.shards[self.route(key)].incr(key,item,when,by)
+    def store_many(self,items):
+        """Store a batch of (key, value) pairs, with one batch per shard."""
+        batches=[[] for shard in self.shards]
+        for (k,v) in items:
+            batches[self.route(k)].append((k,v))
+            self.ops+=1
+        for (shard,batch) in zip(self.shards,batches):
+            if batch:
+                shard.store_many(batch)
+    def fetch_many(self,keys,default=None):
+        """Fetch the values of a batch of keys, with one batch per shard.
+           Return a list of the values, in the same order as keys, with
+           default in place of any key that is not in the database.
+        """
+        keys=list(keys)
+        self.ops+=len(keys)
+        ret=[default]*len(keys)
+        batches=[[] for shard in self.shards]
+        for (i,k) in enumerate(keys):
+            batches[self.route(k)].append(i)
+        for (shard,batch) in zip(self.shards,batches):
+            if batch:
+                vals=shard.fetch_many([keys[i] for i in batch],default)
+                for (i,v) in zip(batch,vals):
+                    ret[i]=v
+        return ret
+    def remove(self,key):
+        """Remove the key from cache and database. Return the old value from
+           the database.
+           Raises KeyError if the key was not in the database.
+        """
+        self.ops+=1
+        return self.shards[self.route(key)].remove(key)
+    def exit(self):
+        """Persist every shard in preparation to exit."""
+        for shard in self.shards:
+            shard.exit()
+
 if __name__ == "__main__":
+    if len(sys.argv)>2 and sys.argv[1]=="export":
+        """crusher.py export name: write the text dump for the database
+           saved for name, for databases saved without one.
+        """
+        if os.path.exists(sys.argv[2]+"-db.sqlite"):
+            SQLiteDataBase(sys.argv[2]).export()
+        else:
+            DataBase(sys.argv[2], lazy=True).export()
+        sys.exit(0)
+
     key=("hello","world")
     val=("by","jove")
     keystr="{}".format(key)
@@ -366,6 +1863,10 @@ if __name__ == "__main__":
     except KeyError as error:
         print("Not found")
     
+    """Store and fetch a batch of key-value pairs in one pass."""
+    cache.store_many([(("batch",i),i*i) for i in range(5)])
+    print(cache.fetch_many([("batch",i) for i in range(6)],"Not found"))
+    
     """Test the ctrl-C handling logic."""
     print("Please press Ctrl-C")
     while not cache.doExit:
@@ -27,10 +27,25 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 
+    Ver 1.04, 10/18/2026: NameAllocator checks its counter, and old names.
+    Ver 1.03, 10/18/2026: Status lists can be kept separately for a scope.
+    Ver 1.02, 10/18/2026: Grouped mode, listing items by the start of their key.
+    Ver 1.01, 10/18/2026: Compact mode, with packed keys and interned item keys.
+    Ver 1.00, 10/18/2026: NameAllocator hands out unique names.
+    Ver 0.99, 10/18/2026: Optional index of dictlists by status, and discard.
+    Ver 0.98, 10/18/2026: Items are added under the database's lock.
+    Ver 0.97, 10/18/2026: inc can increment by more than 1.
+    Ver 0.96, 10/18/2026: Iteration fetches items in chunks.
+    Ver 0.95, 10/18/2026: Optional local copy of the index and item count.
+    Ver 0.94, 10/18/2026: inc uses the database's incr operation.
     Ver 0.93, 11/11/2016: Allow counters with value None act as 0.
     Ver 0.92, 11/11/2016: Added doc strings.
 """
 
+import contextlib
+import random
+import zlib
+
 def indexName(dictname, key):
     """Return the underlying key used for key-based access to an item 
        identified by key in the dictlist named dictname.
@@ -55,6 +70,57 @@ def statusName(dictname):
     """
     return (dictname, "S")
 
+def varint(n):
+    """Return the bytes for the non-negative int n, 7 bits at a time from
+       the lowest, with the top bit set in every byte but the last.
+    """
+    out=bytearray()
+    while n>=0x80:
+        out.append(n&0x7F|0x80)
+        n>>=7
+    out.append(n)
+    return bytes(out)
+
+def packedPrefix(dictname):
+    """Return the bytes that start every underlying key of the compact
+       dictlist named dictname: the length of the name, then the name.
+    """
+    name=dictname.encode()
+    return varint(len(name))+name
+
+def statusListName(stat, scope=None):
+    """Return the name of the dictlist that lists the dictlists with the
+       status stat, for the statuses that are indexed. Dictlists with a
+       scope are listed separately from those of other scopes.
+    """
+    if scope==None:
+        return ("S", stat)
+    return ("S", stat, scope)
+
+def groupListName(dictname, first):
+    """Return the name of the dictlist that lists the items of the grouped
+       dictlist named dictname whose keys are tuples starting with first.
+    """
+    return (dictname, "G", first)
+
+def withStatus(db, stat, symbols=None, scope=None):
+    """Yield the names of the dictlists in db that are indexed by status,
+       with scope, and have the status stat. If they are compact, symbols
+       is their SymbolTable.
+       The names are read before any is yielded, so the caller can change
+       their statuses as it goes. A name is only yielded if the dictlist
+       still has the status, since a crash can leave a name listed under
+       its old status.
+    """
+    names=[tup[0] for tup in CrusherDict(db,statusListName(stat,scope))]
+    keys=[CrusherDict(db,name,symbols=symbols).statusKey() for name in names]
+    for (name, old) in zip(names, db.fetch_many(keys)):
+        if old==stat:
+            yield name
+
+"""Placeholder for an item that is missing from the database."""
+MISSING=object()
+
 class CrusherDict:
     """A CrusherDict is a dictlist built on top of a dictionary.
        The dictlist is identified by a name. It has a status and
@@ -77,22 +143,181 @@ class CrusherDict:
 
        Key: (dictname, "X", key)
        Value: The index of the item with the specified key.
+
+       If symbols is a SymbolTable, the CrusherDict is compact. Each item
+       key is stored as its symbol from the table, and the underlying keys
+       are packed into bytes: packedPrefix(dictname) followed by b"S",
+       b"N", b"E" and the varint of n, or b"X" and the varint of the
+       symbol. The items are (symbol, value, when), and are turned back
+       into (key, value, when) when they are read.
+
+       If local is True, the CrusherDict keeps its own copy of the index
+       and the number of items, which is only correct if it is the only
+       writer of this dictlist. Every checkEvery uses of the copy, the
+       database is read instead and compared, and the copy is discarded
+       if they do not match.
+
+       Iteration reads the items from the database chunk items at a time.
+
+       While the status of the CrusherDict is one of the statuses in
+       indexed, its name is an item of the dictlist
+       statusListName(status, scope), so that withStatus can find it
+       without a scan of the database.
+
+       If grouped is True, each item whose key is a tuple is listed when it
+       is added, under the rest of its key and with its index as the value,
+       in the dictlist groupListName(dictname, key[0]). Then group and top
+       only read the items whose keys start with the same thing. Items
+       added before the CrusherDict was grouped are listed by regroup.
+
+       On a concurrent Broker, items are added while holding the lock of
+       the key of the number of items, and the key of the item is looked up
+       again once it is held, so two threads cannot add items at the same
+       index, or the same key twice. Items that are already there are
+       changed without the lock.
     """
-    def __init__(self, db, dictname):
+    def __init__(self, db, dictname, local=False, checkEvery=100, chunk=64,
+                 indexed=(), symbols=None, grouped=False, scope=None):
         """Create a dictlist named dictname in the underlying database db."""
         self.db=db
         self.name=dictname
-    def __len__(self):
-        """Return the number of items in this CrusherDict."""
+        self.grouped=grouped
+        self.symbols=symbols
+        if symbols!=None:
+            self.prefix=packedPrefix(dictname)
+        self.chunk=chunk
+        self.indexed=indexed
+        self.scope=scope
+        self.local=local
+        self.checkEvery=checkEvery
+        self.localIndex={}
+        self.localCount=None
+        self.uses=0
+        self.mismatches=0
+        if hasattr(db,"lock"):
+            self.guard=db.lock(countName(dictname))
+        else:
+            self.guard=contextlib.nullcontext()
+        self.concurrent=not isinstance(self.guard,contextlib.nullcontext)
+    def statusKey(self):
+        """Return the underlying key of the status."""
+        if self.symbols==None:
+            return statusName(self.name)
+        return self.prefix+b"S"
+    def countKey(self):
+        """Return the underlying key of the number of items."""
+        if self.symbols==None:
+            return countName(self.name)
+        return self.prefix+b"N"
+    def entryKey(self, n):
+        """Return the underlying key of item n."""
+        if self.symbols==None:
+            return entryName(self.name,n)
+        return self.prefix+b"E"+varint(n)
+    def indexKey(self, k):
+        """Return the underlying key of the index of the item whose key is
+           stored as k.
+        """
+        if self.symbols==None:
+            return indexName(self.name,k)
+        return self.prefix+b"X"+varint(k)
+    def stored(self, key):
+        """Return key as it is stored in an item: as its symbol if the
+           CrusherDict is compact, and with a list made a tuple.
+        """
+        if isinstance(key,list):
+            key=tuple(key)
+        if self.symbols==None:
+            return key
+        return self.symbols.symbol(key)
+    def decode(self, item):
+        """Return the item with its stored key turned back into the key."""
+        if self.symbols==None:
+            return item
+        return (self.symbols.key(item[0]),)+tuple(item[1:])
+    def checkDue(self):
+        """Count a use of the local copy, and return whether this use
+           should be checked against the database.
+        """
+        self.uses+=1
+        return self.uses%self.checkEvery==0
+    def forget(self):
+        """Discard the local copy, since it does not match the database."""
+        self.mismatches+=1
+        self.localIndex.clear()
+        self.localCount=None
+    def indexOf(self, key):
+        """Return the index of the item with the key.
+           Raises a KeyError if there is no such item.
+        """
+        k=self.stored(key)
+        if not self.local:
+            return self.db.fetch(self.indexKey(k))
+        if(k in self.localIndex and not self.checkDue()):
+            return self.localIndex[k]
+        try:
+            n=self.db.fetch(self.indexKey(k))
+        except KeyError:
+            if k in self.localIndex:
+                self.forget()
+            raise
+        if(self.localIndex.get(k,n)!=n):
+            self.forget()
+        self.localIndex[k]=n
+        return n
+    def lookup(self, key):
+        """Return (n, count): the index of the item with the key, or None if
+           there is no such item, and the number of items. Without a local
+           copy, both are read with one fetch_many.
+        """
+        if self.local:
+            try:
+                n=self.indexOf(key)
+            except KeyError:
+                n=None
+            return (n, self.itemCount())
+        (n, count)=self.db.fetch_many([self.indexKey(self.stored(key)),
+                                       self.countKey()], MISSING)
+        return (None if n is MISSING else n, 0 if count is MISSING else count)
+    def itemCount(self):
+        """Return the number of items, or 0 if it has not been stored."""
+        if(self.local and self.localCount!=None and not self.checkDue()):
+            return self.localCount
         try:
-            return self.db.fetch(countName(self.name))
+            n=self.db.fetch(self.countKey())
         except KeyError:
-            return 0
+            n=0
+        if self.local:
+            if(self.localCount!=None and self.localCount!=n):
+                self.forget()
+            self.localCount=n
+        return n
+    def added(self, k, n):
+        """Note in the local copy that item n with the stored key k was
+           added.
+        """
+        if self.local:
+            self.localIndex[k]=n
+            self.localCount=n+1
+    def listed(self, key, n):
+        """List item n, with key, in its group, if the CrusherDict is
+           grouped.
+           This is done before the item is added. If the item is never
+           added, the group lists an index that is not its, which group
+           checks for.
+        """
+        if isinstance(key,list):
+            key=tuple(key)
+        if(self.grouped and isinstance(key,tuple) and len(key)>1):
+            CrusherDict(self.db,groupListName(self.name,key[0])).getKey(key[1:],n)
+    def __len__(self):
+        """Return the number of items in this CrusherDict."""
+        return self.itemCount()
     def __contains__(self,key):
         """Returns whether the key is the key of an item in the CrusherDict."""
         try:
             """Look up the key in the index."""
-            self.db.fetch(indexName(self.name,key))
+            self.indexOf(key)
             """Found it in the index, so return True."""
             return True
         except KeyError:
@@ -102,7 +327,7 @@ class CrusherDict:
         """Get and optionally set to stat the status of the CrusherDict.
            Returns None if the status has not been set.
         """
-        name=statusName(self.name)
+        name=self.statusKey()
         try:
             """Get the stored status."""
             old=self.db.fetch(name)
@@ -110,8 +335,16 @@ class CrusherDict:
             """There is no stored status."""
             old=None
         if stat!=None:
+            """List the dictlist under its new status before storing it,
+               and take it off the list of its old status after, so that it
+               is always listed under a status it has.
+            """
+            if(stat in self.indexed and stat!=old):
+                CrusherDict(self.db,statusListName(stat,self.scope)).getKey(self.name)
             """Store the new status."""
             self.db.store(name,stat)
+            if(old in self.indexed and stat!=old):
+                CrusherDict(self.db,statusListName(old,self.scope)).discard(self.name)
         """Return the previously stored status."""
         return old
     def getKey(self, key, val=None):
@@ -126,41 +359,45 @@ class CrusherDict:
             """Look up the index of the item with this key.
                Then, get the underlying key for this item.
             """
-            dbkey=entryName(self.name,self.db.fetch(indexName(self.name,key)))
+            dbkey=self.entryKey(self.indexOf(key))
             if(val!=None):
                 """Change the value stored for this item.
                    What we actually store is a tuple, containing the
                    key and the value.
                 """
-                self.db.store(dbkey, (key,val))
+                self.db.store(dbkey, (self.stored(key),val))
             """Return the underlying key."""
             return dbkey
         except KeyError:
             """There is no item with this key yet."""
-            try:
-                """Get the index for this new item."""
-                n=self.db.fetch(countName(self.name))
-            except KeyError:
-                """There are no items in the list yet, so the index is 0."""
-                n=0
-            """get the underlying key for this item."""
-            dbkey=entryName(self.name,n)
-            """Create the item.
-               What we actually store is a tuple, containing the
-               key and the value.
-            """
-            self.db.store(dbkey, (key,val))
-            """Create the index for the item to find it by key."""
-            self.db.store(indexName(self.name,key), n)
-            """Update the number of items in the list, which makes the item
-               officially in the list.
-            """
-            self.db.store(countName(self.name),n+1)
-            """Return the underlying key of the new item."""
-            return dbkey
-    def inc(self, key, when=None):
-        """Increment the value for key from the set.
-           If the key is not in the set, it is added to the set with value 1.
+            with self.guard:
+                if self.addedMeanwhile(key):
+                    return self.getKey(key,val)
+                """Get the index for this new item, which is 0 if there are no
+                   items in the list yet.
+                """
+                n=self.itemCount()
+                """get the underlying key for this item."""
+                dbkey=self.entryKey(n)
+                """Create the item.
+                   What we actually store is a tuple, containing the
+                   key and the value.
+                """
+                k=self.stored(key)
+                self.listed(key,n)
+                self.db.store(dbkey, (k,val))
+                """Create the index for the item to find it by key."""
+                self.db.store(self.indexKey(k), n)
+                """Update the number of items in the list, which makes the item
+                   officially in the list.
+                """
+                self.db.store(self.countKey(),n+1)
+                self.added(k,n)
+                """Return the underlying key of the new item."""
+                return dbkey
+    def inc(self, key, when=None, by=1):
+        """Increment the value for key from the set by by.
+           If the key is not in the set, it is added to the set with value by.
            when is also stored in the item, as a marker of when
            this value was last changed.
            The key that is used to identify the key in the db
@@ -170,49 +407,351 @@ class CrusherDict:
             """Look up the index of the item with this key.
                Then, get the underlying key for this item.
             """
-            dbkey=entryName(self.name,self.db.fetch(indexName(self.name,key)))
-            """Get the stored value."""
-            v=self.db.fetch(dbkey)
-            """Store the item with its new value.
-               The format is (key, count, when).
+            dbkey=self.entryKey(self.indexOf(key))
+            """Have the database increment the stored value in one
+               operation. The format is (key, count, when).
             """
-            if(v[1]==None):
-                self.db.store(dbkey, (key,1,when))
-            else:
-                self.db.store(dbkey, (key,v[1]+1,when))
-            """Return the undrlying key."""
+            self.db.incr(dbkey, self.stored(key), when, by)
+            """Return the underlying key."""
             return dbkey
         except KeyError:
             """The item is not created yet."""
-            try:
-                """Get the index for this new item."""
-                n=self.db.fetch(countName(self.name))
-            except KeyError:
-                """There are no items in the list yet, so the index is 0."""
-                n=0
-            """get the underlying key for this item."""
-            dbkey=entryName(self.name,n)
-            """Store the item with its new value.
-               The format is (key, count, when).
-            """
-            self.db.store(dbkey,(key,1,when))
-            """Create the index for the item to find it by key."""
-            self.db.store(indexName(self.name,key), n)
-            """Update the number of items in the list, which makes the item
-               officially in the list.
+            with self.guard:
+                if self.addedMeanwhile(key):
+                    return self.inc(key,when,by)
+                """Get the index for this new item, which is 0 if there are no
+                   items in the list yet.
+                """
+                n=self.itemCount()
+                """get the underlying key for this item."""
+                dbkey=self.entryKey(n)
+                """Store the item with its new value.
+                   The format is (key, count, when).
+                """
+                k=self.stored(key)
+                self.listed(key,n)
+                self.db.store(dbkey,(k,by,when))
+                """Create the index for the item to find it by key."""
+                self.db.store(self.indexKey(k), n)
+                """Update the number of items in the list, which makes the item
+                   officially in the list.
+                """
+                self.db.store(self.countKey(),n+1)
+                self.added(k,n)
+                """Return the underlying key of the new item."""
+                return dbkey
+    def addedMeanwhile(self, key):
+        """Return whether another thread added an item with the key after
+           it was looked up, which can only happen on a concurrent Broker.
+           Called while holding the guard.
+        """
+        if not self.concurrent:
+            return False
+        try:
+            self.indexOf(key)
+            return True
+        except KeyError:
+            return False
+    def get(self, key):
+        """Return the item identified by key, as (key, value) or
+           (key, counter, when).
+           Raises a KeyError if there is no such item.
+        """
+        return self.decode(self.db.fetch(self.entryKey(self.indexOf(key))))
+    def group(self, first):
+        """Return the list of items whose keys are tuples starting with
+           first, in the order they were added, if the CrusherDict is
+           grouped. Only the items in the group are read.
+        """
+        members=list(CrusherDict(self.db,groupListName(self.name,first)))
+        keys=[self.entryKey(tup[1]) for tup in members]
+        items=[]
+        for (tup,item) in zip(members,self.db.fetch_many(keys,MISSING)):
+            if item is MISSING:
+                continue
+            item=self.decode(item)
+            if(item[0]==(first,)+tup[0]):
+                """Leave out an index that was listed for an item that
+                   was never added, and then went to another item.
+                """
+                items.append(item)
+        return items
+    def regroup(self):
+        """List each item in its group if it is not listed there, as for
+           the items added before the CrusherDict was grouped.
+        """
+        groups={}
+        for (n,item) in enumerate(self):
+            key=item[0]
+            if(isinstance(key,tuple) and len(key)>1):
+                groups.setdefault(key[0],[]).append((key[1:],n))
+        for (first,members) in groups.items():
+            g=CrusherDict(self.db,groupListName(self.name,first))
+            listed={tup[0]:tup[1] for tup in g}
+            for (rest,n) in members:
+                if listed.get(rest)!=n:
+                    g.getKey(rest,n)
+    def top(self, first, k=None):
+        """Return the k items with the largest counters among the items
+           whose keys start with first, largest first and then in order of
+           key, or all of them if k is None. The CrusherDict must be
+           grouped.
+        """
+        items=sorted(self.group(first),
+                     key=lambda item: (-(item[1] or 0), item[0]))
+        return items[:k]
+    def drop(self, dbkey):
+        """Remove the underlying key dbkey from the database, if it is
+           there.
+        """
+        try:
+            self.db.remove(dbkey)
+        except KeyError:
+            """It is already gone."""
+    def discard(self, key):
+        """Remove the item identified by key, if there is one.
+           The last item is moved into its place, so the indices of the
+           other items do not change.
+        """
+        with self.guard:
+            (n, count)=self.lookup(key)
+            if n==None:
+                """There is no item with this key."""
+                return
+            last=count-1
+            if(n!=last):
+                """Move the last item into the place of the removed one,
+                   and index it there.
+                """
+                try:
+                    item=self.db.fetch(self.entryKey(last))
+                except KeyError:
+                    """The last item is missing, so its place is what
+                       is left missing instead.
+                    """
+                    item=None
+                if item==None:
+                    self.drop(self.entryKey(n))
+                else:
+                    self.db.store(self.entryKey(n),item)
+                    self.db.store(self.indexKey(item[0]),n)
+                    if self.local:
+                        self.localIndex[item[0]]=n
+            """Remove the index of the item, and then the last item, which
+               is no longer in the list once the number of items is updated.
             """
-            self.db.store(countName(self.name),n+1)
-            """Return the underlying key of the new item."""
-            return dbkey
+            self.drop(self.indexKey(self.stored(key)))
+            self.db.store(self.countKey(),last)
+            self.drop(self.entryKey(last))
+            if self.local:
+                self.localIndex.pop(self.stored(key),None)
+                self.localCount=last
     def __iter__(self):
         """Iterate over the items in the CrusherDict, in index order.
            Items are represented as tuples, either (key, value) or
            (key, counter, when) tuples.
+           The items are fetched chunk at a time with one bulk read, but
+           are yielded one at a time. A KeyError is raised when a missing
+           item is reached, not when its chunk is read.
+        """
+        """Find out how many items there are, and loop over the chunks."""
+        n=self.__len__()
+        for start in range(0,n,self.chunk):
+            keys=[self.entryKey(i) for i in range(start,min(n,start+self.chunk))]
+            for (k,item) in zip(keys,self.db.fetch_many(keys,MISSING)):
+                if item is MISSING:
+                    raise KeyError(k)
+                """Yield each item in turn. """
+                yield self.decode(item)
+
+class SymbolTable:
+    """A SymbolTable interns keys as small ints, for compact CrusherDicts.
+       The symbol of a key is its index in the dictlist name. Keys are only
+       ever added to the table, so the table keeps its own copy of every
+       symbol it has used, and only goes to the database for new ones.
+    """
+    def __init__(self, db, name="Y"):
+        """Create a table of symbols kept in the dictlist name of db."""
+        self.db=db
+        self.table=CrusherDict(db,name)
+        self.symbols={}
+        self.keys={}
+    def symbol(self, key):
+        """Return the symbol of key, adding key to the table if needed."""
+        try:
+            return self.symbols[key]
+        except KeyError:
+            """Not used yet, so look it up in the database."""
+        n=self.table.getKey(key)[2]
+        self.symbols[key]=n
+        self.keys[n]=key
+        return n
+    def key(self, n):
+        """Return the key whose symbol is n."""
+        try:
+            return self.keys[n]
+        except KeyError:
+            """Not used yet, so look it up in the database."""
+        key=self.db.fetch(entryName(self.table.name,n))[0]
+        self.symbols[key]=n
+        self.keys[n]=key
+        return key
+
+"""The digits of the names that a NameAllocator hands out."""
+DIGITS="0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+class NameAllocator:
+    """A NameAllocator hands out unique names, each a prefix followed by
+       width base 36 digits, without looking them up in the database.
+       The names are numbered by a counter, which is kept in the dictlist
+       "A" of the database. The counter is advanced block numbers at a
+       time, and those numbers are then handed out without going to the
+       database, so a restart skips at most the rest of a block, and never
+       hands out a name again. Allocators sharing the database share the
+       counter, since the database advances it in one operation.
+
+       Each number is mapped to a name by a permutation, so that names
+       handed out one after another do not look alike. The permutation is
+       a Feistel network on enough bits for all of the names, keyed by key,
+       and a result that is too big is permuted again until it fits.
+
+       If stride is more than 1, only names whose base 36 value is offset
+       modulo stride are handed out, so that allocators with different
+       offsets never hand out the same name.
+
+       The counter is read through the noisy database, so the end of each
+       block is also recorded with a checksum, as the high-water mark. A
+       counter that comes back below the mark was damaged, and is advanced
+       past the mark before any of its numbers are handed out.
+
+       The names of a database that was used before it had allocators were
+       picked at random, so a new name can be one of them. If legacy is
+       True when the first allocator of a database starts, the status of
+       the dictlist "A" is set to "PROBE", and every allocator of that
+       database then skips the names that have a status or items.
+       Otherwise it is set to "COUNT", and names are not looked up.
+    """
+    def __init__(self, db, prefix, width=6, block=1024, key=None,
+                 stride=1, offset=0, rounds=4, legacy=False):
+        """Create an allocator of names starting with prefix in db.
+           The permutation is keyed by the prefix, unless key is given.
+        """
+        self.db=db
+        self.prefix=prefix
+        self.width=width
+        self.block=block
+        self.stride=stride
+        self.offset=offset
+        self.counter=(prefix, stride, offset)
+        self.mark=self.counter+("mark",)
+        self.legacy=legacy
+        self.probing=None
+        """Number of names that can be handed out."""
+        self.size=(len(DIGITS)**width-offset-1)//stride+1
+        self.half=(max(2,(self.size-1).bit_length())+1)//2
+        self.mask=(1<<self.half)-1
+        if key==None:
+            key=zlib.crc32(prefix.encode())
+        rng=random.Random(key)
+        self.keys=[rng.getrandbits(64) for i in range(rounds)]
+        self.next=0
+        self.end=0
+    def scheme(self, a):
+        """Return the status of the dictlist a, which says whether names
+           are looked up, and set it if this is the first allocator.
+           A missing status is read again before it is set, since the
+           status may have been lost on the way out of the database.
+        """
+        for attempt in range(3):
+            stat=a.status()
+            if stat!=None:
+                return stat
+        stat="PROBE" if self.legacy else "COUNT"
+        a.status(stat)
+        return stat
+    def checksum(self, end):
+        """Return the checksum of the high-water mark end."""
+        return zlib.crc32(repr((self.counter, end)).encode())
+    def highWater(self, a):
+        """Return the high-water mark in the dictlist a, or 0 if there is
+           none. A damaged mark is read again, and then ignored.
         """
-        """Find out how many items there are, and loop over the indexes."""
-        for i in range(self.__len__()):
-            """Yield each item in term. """
-            yield self.db.fetch(entryName(self.name,i))
+        for attempt in range(3):
+            try:
+                item=self.db.fetch(a.getKey(self.mark))
+            except KeyError:
+                continue
+            if(item==(self.mark,None)):
+                break
+            if(isinstance(item,tuple) and len(item)==2 and
+               isinstance(item[1],tuple) and len(item[1])==2 and
+               item[1][1]==self.checksum(item[1][0])):
+                return item[1][0]
+        return 0
+    def reserve(self):
+        """Advance the counter in the database by a block, and hand out the
+           numbers of that block.
+        """
+        a=CrusherDict(self.db,"A")
+        if self.probing==None:
+            self.probing=self.scheme(a)=="PROBE"
+        mark=self.highWater(a)
+        dbkey=a.inc(self.counter,None,0)
+        by=self.block
+        while True:
+            """The by numbers below end are this allocator's alone, since
+               the database advanced the counter by by in one operation.
+               The block below end is handed out once it is above the mark.
+            """
+            end=self.db.incr(dbkey,self.counter,None,by)[1]
+            if end-self.block>=mark:
+                break
+            by=max(self.block,mark+self.block-end)
+        a.getKey(self.mark,(end,self.checksum(end)))
+        self.next=end-self.block
+        self.end=min(end,self.size)
+        if(self.next>=self.size):
+            raise OverflowError("No names left for prefix {}".format(self.prefix))
+    def inUse(self, name):
+        """Return whether the dictlist name has a status or items."""
+        for dbkey in (statusName(name), countName(name)):
+            try:
+                self.db.fetch(dbkey)
+                return True
+            except KeyError:
+                """Not this one."""
+        return False
+    def mix(self, half, i):
+        """Return the round i function of the Feistel network on half."""
+        x=((half^self.keys[i])*0x9E3779B97F4A7C15)&0xFFFFFFFFFFFFFFFF
+        return (x>>32^x)&self.mask
+    def permute(self, n):
+        """Return the number that n is mapped to, which is less than size."""
+        while True:
+            left=n>>self.half
+            right=n&self.mask
+            for i in range(len(self.keys)):
+                (left, right)=(right, left^self.mix(right,i))
+            n=left<<self.half|right
+            if(n<self.size):
+                return n
+    def name(self, n):
+        """Return the name for number n."""
+        value=self.permute(n)*self.stride+self.offset
+        digits=[]
+        for i in range(self.width):
+            (value, d)=divmod(value,len(DIGITS))
+            digits.append(DIGITS[d])
+        return self.prefix+"".join(reversed(digits))
+    def __call__(self):
+        """Return a new name."""
+        while True:
+            if(self.next>=self.end):
+                self.reserve()
+            self.next+=1
+            name=self.name(self.next-1)
+            if not(self.probing and self.inUse(name)):
+                return name
 
 if __name__=="__main__":
     """Make a Crusher database."""
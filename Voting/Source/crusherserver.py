@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+""" A Broker service, so that several front ends can share one Crusher
+    database. The server runs one Broker in an asyncio event loop, and
+    serves clients over a Unix or TCP socket. BrokerClient has the same
+    interface as crusher.Broker, so CrusherDict and demo.py can use it
+    unchanged.
+
+    Each request and reply is a frame: a 4-byte length and a 1-byte code,
+    followed by that many bytes of pickled arguments or result. Pickles are
+    only safe between trusted processes, so the server is meant for local
+    clients only.
+
+MIT License
+
+Copyright (c) 2016 Steven P. Crain, SUNY Plattsburgh
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+import asyncio
+import crusher
+import os
+import pickle
+import signal
+import socket
+import struct
+import time
+
+FRAME=struct.Struct("!IB")
+"""Request codes."""
+OP_STORE=1
+OP_FETCH=2
+OP_INCR=3
+OP_STORE_MANY=4
+OP_FETCH_MANY=5
+OP_REMOVE=6
+OP_CONFIGURE=7
+OP_SAVE=8
+"""Reply codes."""
+REPLY_OK=0
+REPLY_ERROR=1
+"""A client reads the replies once this many requests are waiting."""
+PIPELINE=64
+
+def frame(code, obj):
+    """Return the frame with code and obj pickled."""
+    data=pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    return FRAME.pack(len(data), code)+data
+
+def parseAddress(address):
+    """Return the address for "host:port", or the path for a Unix socket."""
+    if ":" in address:
+        (host, port)=address.rsplit(":",1)
+        return (host, int(port))
+    return address
+
+class BrokerServer:
+    """BrokerServer serves one Broker to many clients from one event loop.
+       Each client's requests are answered in order. Requests that arrive
+       while earlier ones are being answered are answered as a batch, and
+       a run of stores in a batch is applied with one store_many, unless
+       one of them fails, so that each store gets its own reply. Each
+       client has a bounded queue, so a client that sends faster than it is
+       answered stops being read until the queue has room.
+    """
+    def __init__(self, broker, queueSize=1024):
+        """Create a server for broker."""
+        self.broker=broker
+        self.queueSize=queueSize
+        self.methods={OP_STORE:broker.store, OP_FETCH:broker.fetch,
+                      OP_INCR:broker.incr, OP_STORE_MANY:broker.store_many,
+                      OP_FETCH_MANY:broker.fetch_many,
+                      OP_REMOVE:broker.remove,
+                      OP_CONFIGURE:broker.configure, OP_SAVE:self.save}
+        self.clients={}
+    def save(self):
+        """Persist the database without stopping."""
+        self.broker.db.save(self.broker.history)
+    def call(self, code, args):
+        """Perform one request, and return the frame of the reply."""
+        try:
+            return frame(REPLY_OK, self.methods[code](*args))
+        except Exception as error:
+            return frame(REPLY_ERROR, error)
+    def storeRun(self, run):
+        """Perform a run of store requests with one store_many, and return
+           the frame of the reply to each. If the store_many fails, the
+           stores are performed one at a time, so that an error is only the
+           reply of the store that raised it.
+        """
+        try:
+            self.broker.store_many([args for (code,args) in run])
+        except Exception:
+            return [self.call(*request) for request in run]
+        return [frame(REPLY_OK, None)]*len(run)
+    def stats(self, peer):
+        """Return the throughput of the client peer as a dict."""
+        stats=dict(self.clients[peer])
+        stats["seconds"]=time.monotonic()-stats["started"]
+        stats["rate"]=stats["requests"]/max(stats["seconds"],1e-9)
+        return stats
+    def report(self, peer):
+        """Print the throughput of the client peer."""
+        print("{peer}: {requests} requests in {batches} batches, {seconds:.1f}s ({rate:.0f} requests/s), {bytesIn} bytes in, {bytesOut} bytes out".format(peer=peer, **self.stats(peer)))
+    async def handle(self, reader, writer):
+        """Read the requests of one client into its queue until it
+           disconnects.
+        """
+        peer=writer.get_extra_info("peername") or "client {}".format(id(writer))
+        self.clients[peer]={"requests":0, "batches":0, "bytesIn":0,
+                            "bytesOut":0, "started":time.monotonic()}
+        queue=asyncio.Queue(self.queueSize)
+        answering=asyncio.ensure_future(self.answer(peer, queue, writer))
+        try:
+            while True:
+                (n, code)=FRAME.unpack(await reader.readexactly(FRAME.size))
+                data=await reader.readexactly(n)
+                self.clients[peer]["bytesIn"]+=FRAME.size+n
+                await queue.put((code, pickle.loads(data)))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            """The client disconnected."""
+        await queue.put(None)
+        await answering
+        writer.close()
+        self.report(peer)
+        del self.clients[peer]
+    async def answer(self, peer, queue, writer):
+        """Answer the requests in queue, a batch at a time, until None."""
+        stats=self.clients[peer]
+        while True:
+            batch=[await queue.get()]
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            done=None in batch
+            if done:
+                batch=batch[:batch.index(None)]
+            replies=[]
+            i=0
+            while i<len(batch):
+                j=i+1
+                if batch[i][0]==OP_STORE:
+                    """Apply the whole run of stores at once."""
+                    while j<len(batch) and batch[j][0]==OP_STORE:
+                        j+=1
+                    replies.extend(self.storeRun(batch[i:j]))
+                else:
+                    replies.append(self.call(*batch[i]))
+                i=j
+            data=b"".join(replies)
+            writer.write(data)
+            stats["requests"]+=len(batch)
+            stats["batches"]+=1
+            stats["bytesOut"]+=len(data)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                """The client will not read the replies anyway."""
+            if done:
+                return
+    async def serve(self, address):
+        """Serve clients at address until SIGINT or SIGTERM, and then
+           persist the database.
+        """
+        if isinstance(address, tuple):
+            server=await asyncio.start_server(self.handle, *address)
+        else:
+            if os.path.exists(address):
+                os.remove(address)
+            server=await asyncio.start_unix_server(self.handle, address)
+        stop=asyncio.Event()
+        loop=asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await stop.wait()
+        server.close()
+        if not isinstance(address, tuple):
+            os.remove(address)
+        for peer in self.clients:
+            self.report(peer)
+        self.broker.exit()
+
+class BrokerClient:
+    """BrokerClient has the Broker interface, but performs the operations
+       on the Broker of a BrokerServer.
+       Requests without a result, such as store, are not waited for. They
+       are sent with the next request that has a result, or once pipeline
+       requests are waiting. Their errors are kept until flush is called,
+       which raises the first of them, so a call only raises its own error.
+    """
+    def __init__(self, address, pipeline=PIPELINE):
+        """Connect to the server at address, which is a (host, port) tuple
+           or the path of a Unix socket.
+        """
+        if isinstance(address, tuple):
+            self.sock=socket.create_connection(address)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            self.sock=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(address)
+        self.replies=self.sock.makefile("rb")
+        self.pipeline=pipeline
+        self.out=[]
+        self.waiting=0
+        self.errors=[]
+        self.ops=0
+        self.doExit=False
+        signal.signal(signal.SIGINT, self.interrupt)
+    def interrupt(self, signal, frame):
+        """Flag that an interrupt was received and we should exit ASAP."""
+        self.doExit=True
+    def read(self, n):
+        """Read n bytes from the server."""
+        data=self.replies.read(n)
+        if len(data)<n:
+            raise ConnectionError("The Broker server closed the connection")
+        return data
+    def reply(self):
+        """Read the next reply, and return (ok, result)."""
+        (n, code)=FRAME.unpack(self.read(FRAME.size))
+        self.waiting-=1
+        return (code==REPLY_OK, pickle.loads(self.read(n)))
+    def receive(self, keep):
+        """Send the buffered requests, and read the replies until keep are
+           left. The errors among them are kept for flush.
+        """
+        if self.out:
+            self.sock.sendall(b"".join(self.out))
+            self.out=[]
+        while self.waiting>keep:
+            (ok, result)=self.reply()
+            if not ok:
+                self.errors.append(result)
+    def flush(self):
+        """Wait until every request sent so far has been performed, and
+           raise the first error of the requests without a result since the
+           last flush.
+        """
+        self.receive(0)
+        self.raiseErrors()
+    def raiseErrors(self):
+        """Raise the first error kept for flush, and forget the rest."""
+        if self.errors:
+            error=self.errors[0]
+            self.errors=[]
+            raise error
+    def post(self, code, *args):
+        """Send a request whose result is not needed."""
+        self.ops+=1
+        self.out.append(frame(code, args))
+        self.waiting+=1
+        if self.waiting>=self.pipeline:
+            self.receive(0)
+    def call(self, code, *args):
+        """Send a request, and return its result or raise its error."""
+        self.ops+=1
+        self.out.append(frame(code, args))
+        self.waiting+=1
+        self.receive(1)
+        (ok, result)=self.reply()
+        if not ok:
+            raise result
+        return result
+    def configure(self,s):
+        """Process configuration message s.
+           Raises the error of a message that the Broker rejects.
+        """
+        self.call(OP_CONFIGURE,s)
+    def store(self,key,val):
+        """Store a key-value pair in the database."""
+        self.post(OP_STORE,key,val)
+    def fetch(self,key):
+        """Fetch the value of a key from the database.
+           Raises KeyError if the key is not in the database.
+        """
+        return self.call(OP_FETCH,key)
+    def incr(self,key,item,when=None,by=1):
+        """Increment the counter stored under key, as Broker.incr does."""
+        return self.call(OP_INCR,key,item,when,by)
+    def store_many(self,items):
+        """Store a batch of (key, value) pairs in the database."""
+        self.post(OP_STORE_MANY,list(items))
+    def fetch_many(self,keys,default=None):
+        """Fetch the values of a batch of keys from the database, with
+           default for any key that is not in the database. The default is
+           filled in here, as for crusher.ShardProcess.
+        """
+        return [default if v is crusher.MISSING else v
+                for v in self.call(OP_FETCH_MANY,list(keys),crusher.MISSING)]
+    def remove(self,key):
+        """Remove the key from cache and database. Return the old value from
+           the database.
+           Raises KeyError if the key was not in the database.
+        """
+        return self.call(OP_REMOVE,key)
+    def exit(self):
+        """Have the server persist the database, and disconnect. Then raise
+           the first error that flush would have.
+        """
+        self.call(OP_SAVE)
+        self.replies.close()
+        self.sock.close()
+        print("Goodbye!")
+        self.raiseErrors()
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description="Serve a Crusher database.")
+    parser.add_argument("address",
+        help="host:port to listen on, or the path of a Unix socket")
+    parser.add_argument("name", nargs="?", default="crusher",
+        help="name the database persists to")
+    parser.add_argument("storage", nargs="?", default="memory",
+        choices=sorted(crusher.storages),
+        help="storage engine from crusher.storages")
+    args=parser.parse_args()
+    broker=crusher.Broker(args.name, crusher.storages[args.storage](args.name))
+    asyncio.run(BrokerServer(broker).serve(parseAddress(args.address)))
@@ -26,12 +26,20 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import argparse
 import crusher
 import crusherdict
+import crusherserver
+import io
+import multiprocessing
 import os.path
+import queue
 import random
 import re
+import signal
 import sys
+import time
+import zlib
 
 """The commands dictionary is a convenient way to map from a command string
    to a command function. Yes, this is technically keeping data between
@@ -44,6 +52,159 @@ commands={}
 """
 random.seed()
 
+"""The tallies CrusherDict is kept between voters, so that it can keep a
+   local copy of its index. Like the commands dictionary, that copy could be
+   trivially reconstructed, and it is regularly checked against the
+   database. There is no local copy for a Broker server, since other
+   clients may add tallies. The tallies are grouped by office, so that the
+   TALLY command only reads the tallies of one office.
+"""
+talliesByDB={}
+
+def tallies(db):
+    """Return the CrusherDict for the tallies in db."""
+    if db not in talliesByDB:
+        talliesByDB[db]=crusherdict.CrusherDict(db,"T",
+            local=not isinstance(db,crusherserver.BrokerClient),
+            grouped=True)
+    return talliesByDB[db]
+
+"""In group commit mode, cast voters wait in the group until it is full or
+   has waited too long, and then their tallies are applied together. The
+   group is recorded in the database before the tallies are changed, so
+   clean can roll it back. Voters in the group have not been issued
+   receipts, so losing the group is the same as losing a voter who had not
+   finished casting. A size of 1 turns group commit off.
+"""
+group={"size":1, "latency":0.5, "voters":[], "deltas":{}, "started":None}
+
+"""In parallel mode, each worker process handles the voters of one shard.
+   A voterid belongs to the shard given by its base 36 value modulo the
+   number of shards, so that voterids are unique across shards, and
+   inquiries can be sent to the right worker.
+"""
+shard={"index":0, "count":1}
+
+def shardOf(voterid):
+    """Return the index of the shard that voterid belongs to."""
+    return int(voterid[1:],36)%shard["count"]
+
+"""Front ends that share a Broker server are told apart by their station
+   names. Each station has its own checkpoint, group pointer and list of
+   voters that are not cast, so that cleaning up after one station leaves
+   alone the voters that other stations are in the middle of. A front end
+   with a database of its own has no station name.
+"""
+station={"name":None}
+
+def stationName(name):
+    """Return this station's name for the dictlist name."""
+    if station["name"]==None:
+        return name
+    return (name, station["name"])
+
+"""The NameAllocator for each database and prefix, which hands out names
+   from the blocks it has reserved in the database.
+"""
+allocators={}
+
+def hasVoters(db):
+    """Return whether voters were cast in db, which may then have voters
+       and groups that were named at random, before there were
+       allocators. clean adds the "voters" tally, but only casting counts
+       it. A miss is looked up again, since the key can be damaged on the
+       way.
+    """
+    t=crusherdict.CrusherDict(db,"T")
+    for attempt in range(3):
+        try:
+            return t.get("voters")[1]!=None
+        except KeyError:
+            """Not found this time."""
+    return False
+
+def newName(db, prefix, shards=False):
+    """Return an unused dictlist name starting with prefix.
+       If shards is True, the name also belongs to this worker's shard.
+    """
+    key=(db, prefix, shards)
+    if key not in allocators:
+        legacy=hasVoters(db)
+        if shards:
+            allocators[key]=crusherdict.NameAllocator(db, prefix,
+                stride=shard["count"], offset=shard["index"], legacy=legacy)
+        else:
+            allocators[key]=crusherdict.NameAllocator(db, prefix,
+                                                      legacy=legacy)
+    return allocators[key]()
+
+"""In compact mode, voters are compact CrusherDicts, whose (office,
+   candidate) keys are interned in a SymbolTable for each database. Like
+   the tallies, the table keeps its own copy of the symbols it has used.
+"""
+compact={"on":False}
+symbolsByDB={}
+
+def symbols(db):
+    """Return the SymbolTable for db in compact mode, or None."""
+    if not compact["on"]:
+        return None
+    if db not in symbolsByDB:
+        symbolsByDB[db]=crusherdict.SymbolTable(db)
+    return symbolsByDB[db]
+
+def voterDict(db, voterid):
+    """Return the CrusherDict for voterid. It is listed by status while it
+       is UNCAST, so that clean can find every voter that is not cast.
+    """
+    return crusherdict.CrusherDict(db,voterid,indexed=("UNCAST",),
+                                   symbols=symbols(db),scope=station["name"])
+
+def dictlist(db, name):
+    """Return the CrusherDict for the voter or group name."""
+    if name[0]=="G":
+        return crusherdict.CrusherDict(db,name)
+    return voterDict(db,name)
+
+def full():
+    """Return whether the group has as many voters as it may hold."""
+    return group["size"]>1 and len(group["voters"])>=group["size"]
+
+def flush(db, log, groupid=None):
+    """Apply the tallies of all voters in the group and issue their
+       receipts. The group is recorded as groupid, or a new name.
+    """
+    if not group["voters"]:
+        return
+    t=tallies(db)
+    """Record the group, with its voters as items, before changing any
+       tallies.
+    """
+    if groupid==None:
+        groupid=newName(db,"G")
+    g=crusherdict.CrusherDict(db,groupid)
+    g.status("UNCAST")
+    for voterid in group["voters"]:
+        g.getKey(voterid)
+    """Point to the group, so that clean can find it."""
+    crusherdict.CrusherDict(db,stationName("G")).status(groupid)
+    """Increment each tally once for the whole group, passing the groupid
+       as "when" the tally was last updated.
+    """
+    for (key,n) in group["deltas"].items():
+        t.inc(key,groupid,n)
+    t.inc("voters",groupid,len(group["voters"]))
+    """The votes have been tallied, so change the statuses to cast."""
+    for voterid in group["voters"]:
+        voterDict(db,voterid).status("CAST")
+    g.status("CAST")
+    """Issue the receipts in the order the voters were cast."""
+    for voterid in group["voters"]:
+        inq(db, {}, log, ("INQ",voterid))
+    group["voters"]=[]
+    group["deltas"]={}
+    group["started"]=None
+
 def conf(db, context, log, fields):
     """Perform CONF command.
        This is supposed to adjust the configuration of the Crusher database.
@@ -63,26 +224,8 @@ def voter(db, context, log, fields):
        from before.
     """
     context.clear()
-    try:
-        """Loop until we get a KeyError, which will indicate that we found a
-           new voterid that hasn't been used before.
-        """
-        while True:
-             """Generate a random voterid. There are 36^6 or about 2 billion
-                distinct voterids, so it is very unlikely we will get
-                conflicts very often, since we only have to support 70,000
-                voters.
-             """
-             voterid="V"+"".join(random.sample("0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ",6))
-             """Try to retrieve the number of votes for this voterid."""
-             db.fetch(crusherdict.countName(voterid))
-             """No KeyError? Guess this voterid is already used, so loop to
-                try another one.
-             """
-    except KeyError:
-        """Good!!! We don't have this voter yet."""
-    """Store the voterid in the context."""
-    context["id"]=voterid
+    """Store a new voterid in the context."""
+    context["id"]=newName(db,"V",True)
     """Make an empty list to store the votes in the context."""
     context["votes"]=[]
     """We are in the middle of a voter, so it is a bad time to exit."""
@@ -107,9 +250,9 @@ def cast(db, context, log, fields):
        and issues a receipt.
     """
     """Get a CrusherDict for this voterid."""
-    d=crusherdict.CrusherDict(db,context["id"])
+    d=voterDict(db,context["id"])
     """Get the CrusherDict for the tallies."""
-    t=crusherdict.CrusherDict(db,"T")
+    t=tallies(db)
     """Currently the voter does not exist in the database at all."""
     d.status("UNCAST")
     """The voter just barely exists, having a status of UNCAST only."""
@@ -119,6 +262,16 @@ def cast(db, context, log, fields):
         """
         d.getKey(vote[1:3])
     """The votes have been added to the voter, but not the tallies."""
+    if group["size"]>1:
+        """Add the voter to the group, and leave the tallies to flush."""
+        if not group["voters"]:
+            group["started"]=time.monotonic()
+        group["voters"].append(context["id"])
+        for vote in context["votes"]:
+            key=tuple(vote[1:3])
+            group["deltas"][key]=group["deltas"].get(key,0)+1
+        context.clear()
+        return db.doExit
     for vote in context["votes"]:
         """Find the item in the tallies with key (office, candidate) and
            increment it, passing the voterid as "when" the tally was last
@@ -142,70 +295,585 @@ def inq(db, context, log, fields):
     """Perform INQ command."""
     context.clear()
     log.write("VOTER\n")
-    for tup in crusherdict.CrusherDict(db,fields[1]):
+    for tup in voterDict(db,fields[1]):
         log.write("VOTE\t{}\t{}\n".format(tup[0][0],tup[0][1]))
     log.write("CAST\t{}\n".format(fields[1]))
     return db.doExit
+"""Register this function to run when the INQ command is received."""
 commands["INQ"]=inq
 
+def standings(db, context, log, fields):
+    """Perform TALLY command.
+       This writes the tallies of the office fields[1] so far, highest
+       first and then by candidate, or only the top fields[2] of them.
+       A voter in progress is left to continue after it.
+    """
+    k=int(fields[2]) if len(fields)>2 else None
+    for tup in tallies(db).top(fields[1],k):
+        log.write("TALLY\t{}\t{}\t{}\n".format(tup[0][0],tup[0][1],tup[1]))
+    return db.doExit
+"""Register this function to run when the TALLY command is received."""
+commands["TALLY"]=standings
+
 def report(db, log):
     """Perform final report."""
-    t=crusherdict.CrusherDict(db,"T")
+    t=tallies(db)
     voters=db.fetch(t.getKey("voters"))[1]
     log.write("VOTERS\t{}\n".format(voters))
     for tup in t:
         if tup[0]!="voters":
             log.write("TALLY\t{}\t{}\t{}\n".format(tup[0][0],tup[0][1],tup[1]))
 
+def merge(partials, log):
+    """Perform final report from the tallies of several shards.
+       The tallies are written in sorted order, so that the report does not
+       depend on how the voters were spread over the shards.
+    """
+    counts={}
+    for items in partials:
+        for (key,n) in items:
+            counts[key]=counts.get(key,0)+(n or 0)
+    log.write("VOTERS\t{}\n".format(counts.pop("voters",0)))
+    for key in sorted(counts):
+        log.write("TALLY\t{}\t{}\t{}\n".format(key[0],key[1],counts[key]))
+
+def mergeStandings(texts, k=None):
+    """Return the TALLY command text for one office from the texts of
+       several shards, highest first and then by candidate, as standings
+       writes it, or only the top k.
+    """
+    counts={}
+    for text in texts:
+        for line in text.splitlines():
+            fields=line.split("\t")
+            key=(fields[1],fields[2])
+            counts[key]=counts.get(key,0)+int(fields[3])
+    ranked=sorted(counts.items(), key=lambda kv: (-kv[1], kv[0]))[:k]
+    return "".join("TALLY\t{}\t{}\t{}\n".format(key[0],key[1],n)
+                   for (key,n) in ranked)
+
+def work(index, count, basename, storage, size, latency, packed, confs,
+         inbox, outbox):
+    """Run a worker process for one shard of the database.
+       Chunks of commands arrive on inbox as (seq, lines), and the votelog
+       text for each chunk is put on outbox as (seq, text). Chunks with a
+       seq of None, like configuration changes, produce no text. A None
+       chunk ends the work, and the shard's tallies are put on outbox.
+       A chunk can end in the middle of a voter, whose commands then
+       continue in a later chunk.
+       If the work fails, (None, error) is put on outbox before the error
+       is raised, so that the main process does not wait for the rest.
+       The configuration commands confs are processed before starting.
+    """
+    try:
+        shard["index"]=index
+        shard["count"]=count
+        group["size"]=size
+        group["latency"]=latency
+        compact["on"]=packed
+        name="{}-shard{}".format(basename,index)
+        db=crusher.Broker(name, crusher.storages[storage](name))
+        for conf in confs:
+            db.configure(conf)
+        clean(db)
+        context={}
+        for (seq,lines) in iter(inbox.get, None):
+            log=io.StringIO()
+            for line in lines:
+                """Exiting is up to the main process, which stops sending
+                   chunks.
+                """
+                commands[line[0]](db,context,log,line)
+                if full():
+                    flush(db, log)
+            """The receipts of the chunk must all be in its text."""
+            flush(db, log)
+            if seq!=None:
+                outbox.put((seq, log.getvalue()))
+        outbox.put((None, [(tup[0],tup[1]) for tup in tallies(db)]))
+        db.exit()
+    except Exception as error:
+        outbox.put((None, error))
+        raise
+
+def parallel(count, basename, storage, cmd, log, confs, chunk=256):
+    """Process the commands in cmd with count worker processes, and return
+       the tallies of their shards.
+       Voters are sent to the workers in chunks of up to chunk voters, in
+       turn. Configuration changes go to every worker, and inquiries go to
+       the worker for the voter's shard. Every worker answers a TALLY
+       command with all of its tallies for the office, and the answers are
+       merged. The votelog text comes back out of order, and is held until
+       it can be written in input order.
+       A command in the middle of a voter ends the chunk there, and the
+       rest of the voter goes to the same worker as its start.
+       If a worker fails, the others are stopped and its error is raised.
+       The workers start with the configuration commands confs.
+    """
+    outbox=multiprocessing.Queue()
+    inboxes=[multiprocessing.Queue() for i in range(count)]
+    workers=[multiprocessing.Process(target=work, args=(i, count, basename,
+                 storage, group["size"], group["latency"], compact["on"],
+                 confs, inboxes[i], outbox))
+             for i in range(count)]
+    for w in workers:
+        w.start()
+    """Instead of Broker.doExit, stop at the next voter after CTRL-C."""
+    stop=[]
+    signal.signal(signal.SIGINT, lambda sig, frame: stop.append(sig))
+    shard["count"]=count
+    held={}
+    """The top k and the answers so far of each TALLY command, by seq."""
+    queries={}
+    """The worker with the start of the voter in progress, once its chunk
+       has been sent, and whether a voter is in progress.
+    """
+    state={"seq":0, "written":0, "turn":0, "owner":None, "open":False}
+    def get():
+        """Return the next (seq, text) or (None, tallies) from outbox,
+           checking on the workers while waiting.
+        """
+        while True:
+            try:
+                (seq, result)=outbox.get(timeout=1)
+            except queue.Empty:
+                dead=[w for w in workers if w.exitcode not in (None,0)]
+                if dead:
+                    fail(RuntimeError("Worker process {} exited with code {}".format(
+                        workers.index(dead[0]), dead[0].exitcode)))
+                continue
+            if isinstance(result, Exception):
+                fail(result)
+            return (seq, result)
+    def fail(error):
+        """Stop every worker, and raise error."""
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+            w.join()
+        for inbox in inboxes:
+            """Nothing will read what is left, so do not wait to send it
+               when exiting.
+            """
+            inbox.cancel_join_thread()
+        raise error
+    def drain():
+        """Write the held text that is next in input order."""
+        while state["written"] in held:
+            log.write(held.pop(state["written"]))
+            state["written"]+=1
+    def receive():
+        """Hold the text of one finished chunk, and write what we can."""
+        (seq, text)=get()
+        if seq in queries:
+            (k, texts)=queries[seq]
+            texts.append(text)
+            if len(texts)<count:
+                return
+            del queries[seq]
+            text=mergeStandings(texts, k)
+        held[seq]=text
+        drain()
+    def send(i, lines):
+        """Send lines to worker i, or every worker if i is None, keeping a
+           bounded number in flight.
+        """
+        for inbox in (inboxes if i==None else [inboxes[i]]):
+            inbox.put((state["seq"], lines))
+        state["seq"]+=1
+        while state["seq"]-state["written"]>4*count:
+            receive()
+    lines=[]
+    def dispatch():
+        """Send the collected lines, to the worker with the start of the
+           first voter in them if there is one, and otherwise to the next
+           worker in turn. If the last voter in them is still in progress,
+           the rest of it goes to the same worker.
+        """
+        i=state["owner"]
+        if i==None:
+            i=state["turn"]%count
+            state["turn"]+=1
+        if lines:
+            send(i, lines[:])
+            lines.clear()
+        state["owner"]=i if state["open"] else None
+    voters=0
+    for line in cmd:
+        if line[-1]=="\n":
+            line=line[:-1]
+        line=line.split("\t")
+        if line[0]=="VOTER":
+            if stop:
+                break
+            """Any voter before it has ended."""
+            state["open"]=False
+            if(voters==chunk or state["owner"]!=None):
+                dispatch()
+                voters=0
+            voters+=1
+            state["open"]=True
+        elif line[0]=="CAST":
+            state["open"]=False
+        if line[0] in ("VOTER","VOTE","CAST"):
+            lines.append(line)
+            continue
+        """Other commands must see the voters before them."""
+        if lines:
+            dispatch()
+            voters=0
+        if line[0]=="CONF":
+            for inbox in inboxes:
+                inbox.put((None, [line]))
+            held[state["seq"]]="{}\t{}\n".format(line[0], line[1])
+            state["seq"]+=1
+            drain()
+        elif line[0]=="TALLY":
+            queries[state["seq"]]=(int(line[2]) if len(line)>2 else None, [])
+            send(None, [line[:2]])
+        else:
+            send(shardOf(line[1]), [line])
+    if lines:
+        dispatch()
+    while state["written"]<state["seq"]:
+        receive()
+    for inbox in inboxes:
+        inbox.put(None)
+    partials=[get()[1] for w in workers]
+    for w in workers:
+        w.join()
+    return partials
+
+"""The path of the input file that the checkpoints are for, and the
+   checksum of its first bytes, as (length, crc), that was computed last.
+   A checkpoint only says where to resume in a file that starts with the
+   same commands as the one it was taken in, though more may have been
+   appended since.
+"""
+source={"file":None, "prefix":(0,0)}
+
+def leadingConfs(filename):
+    """Return the configuration commands that the input file starts with.
+       They are in effect from the start, so they are processed before the
+       database is read, instead of leaving that to the default failure
+       rates.
+    """
+    confs=[]
+    with open(filename,"r") as f:
+        for line in f:
+            fields=line.rstrip("\n").split("\t")
+            if fields[0]!="CONF":
+                break
+            confs.append(fields[1])
+    return confs
+
+def checkpoint(db, offset, logged, confs, pending=None):
+    """Record that the commands before byte offset in the input are
+       committed, with their output in the first logged bytes of the
+       votelog, and with the configuration commands confs in effect.
+       pending is (name, after) while the voter or group name is being
+       committed, which takes the input to byte offset after.
+       The checksum of the commands before offset is stored, so that a
+       restart can tell they have not changed, and a checksum of the
+       checkpoint, so a damaged checkpoint can be recognized.
+    """
+    if isinstance(db, crusherserver.BrokerClient):
+        """The stores it waits for are only committed once they are done."""
+        db.flush()
+    c=(offset, logged, tuple(confs), pending, source["file"],
+       prefixChecksum(offset))
+    crusherdict.CrusherDict(db,stationName("C")).status(c+(checksum(c),))
+
+def prefixChecksum(offset):
+    """Return the CRC of the first offset bytes of the input file, or None
+       if it is shorter than that. It carries on from the last one computed,
+       so the input is only read once as the checkpoints move forward.
+    """
+    (length, crc)=source["prefix"]
+    if offset<length:
+        (length, crc)=(0, 0)
+    with open(source["file"],"rb") as f:
+        f.seek(length)
+        while length<offset:
+            chunk=f.read(min(1<<20, offset-length))
+            if not chunk:
+                return None
+            crc=zlib.crc32(chunk, crc)
+            length+=len(chunk)
+    source["prefix"]=(length, crc)
+    return crc
+
+def checksum(c):
+    """Return the checksum of the checkpoint c."""
+    return zlib.crc32(repr(c).encode())
+
+def restart(db):
+    """Return the (offset, logged, confs, pending, file, crc) of the
+       checkpoint to resume from, or a start from the beginning, for no
+       file, if the last run finished.
+       A damaged checkpoint is read again, since it may have been damaged
+       on the way out of the database rather than in it.
+    """
+    c=None
+    for attempt in range(3):
+        c=crusherdict.CrusherDict(db,stationName("C")).status()
+        if(isinstance(c,tuple) and len(c)==7 and checksum(c[:6])==c[6]):
+            return (c[0], c[1], list(c[2]), c[3], c[4], c[5])
+        if(c==None or c=="DONE"):
+            break
+    if(c!=None and c!="DONE"):
+        print("Ignoring damaged checkpoint {}".format(c), file=sys.stderr)
+    return (0, 0, [], None, None, None)
+
+def commit(db, log, mark, after, confs):
+    """Flush the group, whose voters take the input to byte offset after,
+       and return the new checkpoint (offset, logged).
+       The last checkpoint, mark, names the group while it is flushed, so
+       that a restart can tell whether the group was committed.
+    """
+    groupid=newName(db,"G")
+    checkpoint(db, mark[0], mark[1], confs, (groupid, after))
+    flush(db, log, groupid)
+    checkpoint(db, after, log.tell(), confs)
+    return (after, log.tell())
+
+def receipts(db, log, name):
+    """Issue the receipts again for the voter or group name."""
+    if name[0]=="G":
+        for tup in crusherdict.CrusherDict(db,name):
+            inq(db, {}, log, ("INQ",tup[0]))
+    else:
+        inq(db, {}, log, ("INQ",name))
+
+def rollback(db, t, voterid, uncast=False):
+    """Roll back the tallies t that voterid incremented, if the voter was
+       not cast. If uncast is True, the voter is known to be UNCAST, so its
+       status is not read again.
+    """
+    v=voterDict(db,voterid)
+    if(not uncast and v.status()!="UNCAST"):
+        return
+    for key in [tup[0] for tup in v]+["voters"]:
+        try:
+            tally=t.get(key)
+        except KeyError:
+            """The voter stopped before creating this tally."""
+            continue
+        try:
+            if(tally[2]==voterid):
+                t.getKey(key,tally[1]-1)
+        except IndexError:
+            """The tally was previously rolled back, and so
+               does not need to be rolled back this time.
+            """
+    v.status("ROLLEDBACK")
+
 def clean(db):
     """Check the database for any votes that are not properly cast.
     """
-    t=crusherdict.CrusherDict(db,"T")
-    try:
-        voters=db.fetch(t.getKey("voters"))
-        """Get the CrusherDict for the last voter."""
-        v=crusherdict.CrusherDict(db,voters[2]) 
-        """Check if the vote was cast."""
-        if(v.status()!="CAST"):
-            """Last vote was not cast, so roll-back."""
-            for tup in v:
-                tally=db.fetch(t.getKey(tup[0]))
+    t=tallies(db)
+    if t.status()!="GROUPED":
+        """Tallies from before they were grouped are not listed in the
+           groups that TALLY reads, so list them once.
+        """
+        t.regroup()
+        t.status("GROUPED")
+    """Check if the last group was cast."""
+    groupid=crusherdict.CrusherDict(db,stationName("G")).status()
+    if groupid!=None:
+        g=crusherdict.CrusherDict(db,groupid)
+        if(g.status()=="UNCAST"):
+            """Last group was not cast, so roll back every tally that it
+               changed, by the amount that it changed it.
+            """
+            deltas={"voters":len(g)}
+            for tup in g:
+                for vote in voterDict(db,tup[0]):
+                    deltas[vote[0]]=deltas.get(vote[0],0)+1
+            for (key,n) in deltas.items():
+                if key not in t:
+                    """The group stopped before creating this tally."""
+                    continue
+                tally=db.fetch(t.getKey(key))
                 try:
-                    if(tally[2]==voters[2]):
-                        t.getKey(tup[0],tally[1]-1)
+                    if(tally[2]==groupid):
+                        t.getKey(key,tally[1]-n)
                 except IndexError:
                     """The tally was previously rolled back, and so
                        does not need to be rolled back this time.
                     """
-            t.getKey(tup[0],tally[1]-1)
+            """None of the voters in the group were issued receipts."""
+            for tup in g:
+                voterDict(db,tup[0]).status("ROLLEDBACK")
+            g.status("ROLLEDBACK")
+    """Roll back every voter that was not cast, which the status index
+       lists without a scan of the database.
+    """
+    for voterid in crusherdict.withStatus(db,"UNCAST",symbols(db),
+                                          station["name"]):
+        rollback(db, t, voterid, True)
+    if station["name"]!=None:
+        """The last voter may be another station's, which is none of our
+           business.
+        """
+        return
+    try:
+        voters=db.fetch(t.getKey("voters"))
+        if(voters[2]!=groupid):
+            """A database from before the status index only records the
+               last voter.
+            """
+            rollback(db, t, voters[2])
     except IndexError:
         """The tally was previously rolled back, and so
            does not need to be rolled back this time.
         """
 
-try:
-    filename=sys.argv[1]
-except:
-    filename="easy.txt"
-
-basename=os.path.splitext(os.path.basename(filename))[0]
-
-db=crusher.Broker(basename)
-clean(db)
-cmd=open(filename,"r")
-log=open(basename+"-votelog.txt","w")
-context={}
-
-for line in cmd:
-    if line[-1]=="\n":
-        line=line[:-1]
-    line=line.split("\t")
-    if commands[line[0]](db,context,log,line):
-        break
-
-cmd.close()
-log.close()
-results=open(basename+"-results.txt","w")
-report(db,results)
-results.close()
-db.exit()
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description="Process the votes in a file.")
+    parser.add_argument("filename", nargs="?", default="easy.txt")
+    parser.add_argument("storage", nargs="?", default="memory",
+        choices=sorted(crusher.storages),
+        help="storage engine from crusher.storages")
+    parser.add_argument("--group", type=int, default=group["size"],
+        help="maximum number of voters to commit together (1 turns it off)")
+    parser.add_argument("--latency", type=float, default=group["latency"],
+        help="maximum seconds a voter waits in a group for a receipt")
+    parser.add_argument("--workers", type=int, default=1,
+        help="number of worker processes, each with its own shard of the "
+             "database (1 turns it off)")
+    parser.add_argument("--shards", type=int, default=1,
+        help="number of shards to spread the keys over in one Broker "
+             "(1 turns it off)")
+    parser.add_argument("--processes", action="store_true",
+        help="run each of the --shards in its own process")
+    parser.add_argument("--server",
+        help="use the Broker server at host:port or a Unix socket path, "
+             "instead of storage")
+    parser.add_argument("--station",
+        help="name of this front end among those sharing the --server, "
+             "which defaults to the name of the input file")
+    parser.add_argument("--compact", action="store_true",
+        help="store voters compactly, with packed keys and interned "
+             "offices and candidates")
+    args=parser.parse_args()
+    filename=args.filename
+    storage=args.storage
+    group["size"]=args.group
+    group["latency"]=args.latency
+    compact["on"]=args.compact
+
+    basename=os.path.splitext(os.path.basename(filename))[0]
+    if args.server:
+        station["name"]=args.station or basename
+
+    if args.workers>1:
+        cmd=open(filename,"r")
+        log=open(basename+"-votelog.txt","w")
+        partials=parallel(args.workers, basename, storage, cmd, log,
+                          leadingConfs(filename))
+        cmd.close()
+        log.close()
+        results=open(basename+"-results.txt","w")
+        merge(partials,results)
+        results.close()
+    else:
+        if args.server:
+            db=crusherserver.BrokerClient(
+                crusherserver.parseAddress(args.server))
+        elif args.shards>1:
+            db=crusher.ShardedBroker(basename, args.shards, storage,
+                                     args.processes)
+        else:
+            db=crusher.Broker(basename, crusher.storages[storage](basename))
+        for conf in leadingConfs(filename):
+            db.configure(conf)
+        """Resume after the last checkpoint, with the configuration that was
+           in effect there, and discard any votelog written after it. The
+           configuration is restored first, so that cleaning up runs with it
+           too.
+        """
+        source["file"]=os.path.abspath(filename)
+        (offset, logged, confs, pending, resumed, crc)=restart(db)
+        if(resumed!=None and (resumed!=source["file"] or
+                              prefixChecksum(offset)!=crc)):
+            """The offset is only meaningful in the commands it was taken
+               in.
+            """
+            db.exit()
+            sys.exit("The checkpoint is for the first {} bytes of {}, which {} does not start with. Finish that run, or remove the database to start over.".format(offset, resumed, source["file"]))
+        for conf in confs:
+            db.configure(conf)
+        clean(db)
+        log=open(basename+"-votelog.txt","a")
+        log.truncate(logged)
+        log.seek(logged)
+        if(pending and
+           dictlist(db,pending[0]).status()=="CAST"):
+            """The pending voter or group was committed, but its receipts
+               may not have been written, so resume after it.
+            """
+            receipts(db, log, pending[0])
+            offset=pending[1]
+            checkpoint(db, offset, log.tell(), confs)
+        cmd=open(filename,"rb")
+        cmd.seek(offset)
+        context={}
+
+        """The last checkpoint, as (offset, logged)."""
+        mark=(offset, log.tell())
+        """Where a restart could begin: a restart cannot begin inside a
+           voter, so this stays at the start of a voter until it is cast.
+        """
+        begun=offset
+        finished=True
+        for raw in cmd:
+            """The input is read as bytes, to keep track of the offset."""
+            offset+=len(raw)
+            line=raw.decode()
+            if line[-1]=="\n":
+                line=line[:-1]
+            line=line.split("\t")
+            if(line[0]=="VOTER" or "id" not in context):
+                begun=offset-len(raw)
+            if group["voters"]:
+                """Other commands may depend on the group, so it is applied
+                   first. A group is also applied once its first voter has
+                   waited too long.
+                """
+                if(line[0] not in ("VOTER","VOTE","CAST") or
+                   time.monotonic()-group["started"]>=group["latency"]):
+                    mark=commit(db, log, mark, begun, confs)
+            if(line[0]=="CAST" and group["size"]<=1 and "id" in context):
+                """Casting commits the voter, so name it in the checkpoint
+                   first.
+                """
+                checkpoint(db, mark[0], mark[1], confs,
+                           (context["id"], offset))
+            stop=commands[line[0]](db,context,log,line)
+            if line[0]=="CONF":
+                confs=crusher.effectiveConfiguration(confs+[line[1]])
+            if full():
+                mark=commit(db, log, mark, offset, confs)
+            elif(line[0] in ("CAST","CONF","INQ","TALLY") and
+                 not group["voters"] and "id" not in context):
+                """Everything so far is committed."""
+                checkpoint(db, offset, log.tell(), confs)
+                mark=(offset, log.tell())
+            if stop:
+                finished=False
+                break
+
+        if "id" not in context:
+            begun=offset
+        if group["voters"]:
+            mark=commit(db, log, mark, begun, confs)
+        if finished:
+            """The next run starts from the beginning again."""
+            crusherdict.CrusherDict(db,stationName("C")).status("DONE")
+        cmd.close()
+        log.close()
+        results=open(basename+"-results.txt","w")
+        report(db,results)
+        results.close()
+        db.exit()
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+
+""" Tests for the Crusher noisy database and its storage engines.
+
+MIT License
+
+Copyright (c) 2016 Steven P. Crain, SUNY Plattsburgh
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import crusher
+import crusherdict
+import os
+import pickle
+import random
+import tempfile
+import unittest
+
+"""Configuration that turns off every failure."""
+QUIET="((0,1,2,3,4,5,6,7,8),0,0,0,0,0)"
+
+class TestCache(unittest.TestCase):
+    """Cache on its own, with no failures unless a test asks for them."""
+    def test_hash(self):
+        """Slots are the last bytes of the pickled key, whether or not they
+           were remembered, and are worked out again for a new size.
+        """
+        c=crusher.Cache((4,0,0,0,0))
+        c.slotLimit=3
+        keys=[("V{}".format(i),"E",i) for i in range(5)]
+        for key in keys+keys:
+            self.assertEqual(c.hash(key), pickle.dumps(key)[-4:])
+        self.assertLessEqual(len(c.slots), 3)
+        self.assertEqual(c.hash(["V1","E"]), pickle.dumps(["V1","E"])[-4:])
+        c.config((2,0,0,0,0))
+        self.assertEqual(c.hash(keys[4]), pickle.dumps(keys[4])[-2:])
+
+    def cache(self, policy, capacity=2):
+        """Return a cache of capacity entries, with a policy, and with a
+           and b stored, and then a fetched.
+        """
+        c=crusher.Cache((16,0,0,0,0,capacity,policy))
+        c.store("a", 1)
+        c.store("b", 2)
+        c.fetch("a")
+        return c
+    def test_lru(self):
+        """LRU evicts the entry used longest ago."""
+        c=self.cache("LRU")
+        c.store("c", 3)
+        self.assertEqual((c.fetch("a"), c.fetch("c")), (1, 3))
+        with self.assertRaises(KeyError):
+            c.fetch("b")
+        self.assertEqual(c.stats()["evictions"], 1)
+    def test_clock(self):
+        """CLOCK gives every entry used since the hand passed it a second
+           chance, in the order they were stored, where LRU would evict b.
+        """
+        c=self.cache("CLOCK")
+        c.fetch("b")
+        c.fetch("a")
+        c.store("c", 3)
+        self.assertEqual((c.fetch("b"), c.fetch("c")), (2, 3))
+        with self.assertRaises(KeyError):
+            c.fetch("a")
+    def test_random(self):
+        """RANDOM keeps the cache within its capacity."""
+        c=self.cache("RANDOM", 3)
+        for i in range(10):
+            c.store(i, i)
+        self.assertEqual(c.stats()["entries"], 3)
+        self.assertEqual(c.stats()["evictions"], 9)
+    def test_capacity_and_policy_kept(self):
+        """Settings without a capacity or policy keep the ones in effect,
+           and an unknown policy is refused.
+        """
+        c=self.cache("CLOCK")
+        c.config((16,0,0,0,0))
+        self.assertEqual((c.capacity, c.policy), (2, "CLOCK"))
+        with self.assertRaises(ValueError):
+            c.config((16,0,0,0,0,2,"MRU"))
+
+    def test_random_hits(self):
+        """A Random Hit returns any entry in the cache, as (key, value),
+           and only those, after entries have been removed and evicted.
+        """
+        random.seed(1)
+        c=crusher.Cache((16,0,0,0,0,30,"LRU"))
+        for i in range(50):
+            c.store(i, i)
+        for i in range(20,30):
+            c.remove(i)
+        self.assertEqual(sorted(c.order), sorted(c.cache))
+        self.assertTrue(all(c.order[c.pos[hk]]==hk for hk in c.order))
+        c.config((16,0,1e6,0,0))
+        self.assertEqual({c.fetch(-1) for i in range(1000)},
+                         {(i, i) for i in range(30,50)})
+
+    def test_ways(self):
+        """Keys that share a slot are all kept, up to the number of ways,
+           and then the one used longest ago is replaced. Every key shares
+           the slot of a 1-byte cache, which is the end of a pickle.
+        """
+        c=crusher.Cache((1,0,0,0,0))
+        c.store("a", 1)
+        c.store("b", 2)
+        with self.assertRaises(KeyError):
+            c.fetch("a")
+        c.config((1,0,0,0,0,0,"LRU",2))
+        self.assertEqual(c.stats()["entries"], 0)
+        c.store("a", 1)
+        c.store("b", 2)
+        c.fetch("a")
+        c.store("c", 3)
+        self.assertEqual((c.fetch("a"), c.fetch("c")), (1, 3))
+        with self.assertRaises(KeyError):
+            c.fetch("b")
+        self.assertEqual(c.stats()["conflicts"], 2)
+
+class TestPayloadSize(unittest.TestCase):
+    """The memo of payload sizes behind failureTime."""
+    def setUp(self):
+        self.limit=crusher.PAYLOAD_MEMO_SIZE
+        crusher.PAYLOAD_MEMO_SIZE=4
+        crusher.payloadSizes.clear()
+    def tearDown(self):
+        crusher.PAYLOAD_MEMO_SIZE=self.limit
+        crusher.payloadSizes.clear()
+    def test_sizes(self):
+        """Sizes are 8 bits a character of str(data), whether or not they
+           are remembered, and only the most recent are remembered.
+        """
+        data=[("V{}".format(i),"E",i) for i in range(10)]+[["a",[1]]]
+        for x in data+data:
+            self.assertEqual(crusher.payloadBits(x), 8*len(str(x)))
+        self.assertLessEqual(len(crusher.payloadSizes), 4)
+        self.assertEqual(crusher.failureTime(0.5, "abcd"), 16)
+        self.assertFalse(crusher.failure(0, "abcd"))
+
+class TestChannel(unittest.TestCase):
+    """Channel bit flips, drawn once per payload."""
+    def test_flip_positions(self):
+        """Bits are numbered through the items of data, with a leading 0
+           for characters and numbers, and a sign after a negative number.
+        """
+        self.assertEqual(crusher.bitUnits(("a",1,-5,b"xy")), 8+2+12+16)
+        self.assertEqual(crusher.flipBits((1,"a"), [0,2]), (0,"`"))
+        self.assertEqual(crusher.flipBits(-5, [11]), 5)
+        self.assertEqual(crusher.flipBits(b"\x00\x00", [9]), b"\x00\x02")
+    def test_quiet(self):
+        """A quiet channel returns data untouched, with lists made tuples."""
+        c=crusher.Channel((0,0,0))
+        self.assertEqual(c.mangle(["a",[1,2]]), ("a",(1,2)))
+        self.assertEqual(c.bitflip(["a",[1,2]]), ("a",(1,2)))
+    def test_flip_rate(self):
+        """On average, rate flips happen for each bit."""
+        random.seed(1)
+        c=crusher.Channel((0.001,0,0))
+        data="x"*100
+        flips=0
+        for i in range(2000):
+            out=c.bitflip(data)
+            flips+=sum(bin(ord(a)^ord(b)).count("1")
+                       for (a,b) in zip(data,out))
+        self.assertAlmostEqual(flips/2000, 0.001*crusher.bitUnits(data),
+                               delta=0.1)
+
+class InTempDir(unittest.TestCase):
+    """Runs each test in a new directory, since databases persist to files
+       in the current directory.
+    """
+    def setUp(self):
+        self.home=os.getcwd()
+        self.dir=tempfile.TemporaryDirectory()
+        os.chdir(self.dir.name)
+    def tearDown(self):
+        os.chdir(self.home)
+        self.dir.cleanup()
+
+class TestBatches(InTempDir):
+    """store_many and fetch_many on a Broker."""
+    def setUp(self):
+        super().setUp()
+        self.db=crusher.Broker("test", crusher.storages["memory"]("test"))
+        self.db.configure(QUIET)
+    def check(self):
+        """Batches store and fetch what single operations would, and count
+           an operation for each key.
+        """
+        items=[(("V1","E",i),(("Mayor","Ann"),i)) for i in range(10)]
+        self.db.store_many(items)
+        keys=[k for (k,v) in items]+[("V1","E",10)]
+        ops=int(self.db.ops)
+        self.assertEqual(self.db.fetch_many(keys, "none"),
+                         [v for (k,v) in items]+["none"])
+        self.assertEqual(int(self.db.ops), ops+len(keys))
+        self.assertEqual(self.db.fetch(items[3][0]), items[3][1])
+    def test_direct(self):
+        """Nothing can fail, so the batches go straight to the database."""
+        self.assertTrue(self.db.direct)
+        self.check()
+    def test_pipeline(self):
+        """Failures are possible, if too rare to happen, so the batches go
+           through the channels and the cache.
+        """
+        self.db.configure("((1,),1e-15,0,0)")
+        self.assertFalse(self.db.direct)
+        self.check()
+        self.assertEqual(self.db.cache.stats()["entries"], 10)
+
+class TestJournal(InTempDir):
+    """DataBase in journal mode, which is read back without being saved."""
+    def test_replay(self):
+        """Stores and removes are in the journal as soon as they are made."""
+        db=crusher.DataBase("test", journal=True)
+        db.store("a", 1)
+        db.store("b", 2)
+        db.remove("a")
+        self.assertEqual(dict(crusher.DataBase("test").items()), {"b":2})
+        db.close()
+    def test_torn_record(self):
+        """A record cut short by a crash is dropped, and the journal goes
+           on after the good records.
+        """
+        db=crusher.DataBase("test", journal=True)
+        db.store("a", 1)
+        db.close()
+        with open("test-db.log", "ab") as f:
+            f.write(b"\x01\x00\x00")
+        db=crusher.DataBase("test", journal=True)
+        db.store("b", 2)
+        db.close()
+        self.assertEqual(dict(crusher.DataBase("test").items()),
+                         {"a":1, "b":2})
+    def test_compaction(self):
+        """The journal is compacted into the snapshot after compactEvery
+           records, and nothing is lost.
+        """
+        db=crusher.DataBase("test", journal=True, compactEvery=4)
+        for i in range(10):
+            db.store(i, i*i)
+        db.remove(0)
+        db.close()
+        self.assertTrue(os.path.exists("test-db.dat"))
+        self.assertFalse(os.path.exists("test-db.log.old"))
+        self.assertEqual(dict(crusher.DataBase("test").items()),
+                         {i:i*i for i in range(1,10)})
+
+class TestLazySnapshot(InTempDir):
+    """DataBase in lazy mode, which maps an indexed snapshot."""
+    def setUp(self):
+        super().setUp()
+        self.data={("V{}".format(i),"E",0):(("Mayor","Ann"),None)
+                   for i in range(100)}
+        db=crusher.DataBase("test", lazy=True, text=False)
+        for (k,v) in self.data.items():
+            db.store(k, v)
+        db.save([])
+        db.close()
+    def test_values_read_when_fetched(self):
+        """Only the values that are fetched are read from the snapshot."""
+        db=crusher.DataBase("test", lazy=True)
+        self.assertIsInstance(db.cache, crusher.SnapshotDict)
+        self.assertEqual(db.fetch(("V7","E",0)), self.data[("V7","E",0)])
+        self.assertEqual(list(db.cache.overlay), [("V7","E",0)])
+        with self.assertRaises(KeyError):
+            db.fetch(("V100","E",0))
+    def test_changes(self):
+        """Changes are kept on top of the snapshot until the next one."""
+        db=crusher.DataBase("test", lazy=True)
+        db.remove(("V1","E",0))
+        db.store(("V2","E",0), "changed")
+        with self.assertRaises(KeyError):
+            db.fetch(("V1","E",0))
+        self.data.pop(("V1","E",0))
+        self.data[("V2","E",0)]="changed"
+        self.assertEqual(dict(db.items()), self.data)
+        db.save([])
+        db.close()
+        self.assertEqual(dict(crusher.DataBase("test").items()), self.data)
+
+class TestIncr(InTempDir):
+    """Broker.incr, which increments a counter in one operation."""
+    def setUp(self):
+        super().setUp()
+        self.db=crusher.Broker("test", crusher.storages["memory"]("test"))
+        self.db.configure(QUIET)
+    def check(self):
+        """A counter of None counts from 0, the new value is returned and
+           stored, and the caller's item replaces a damaged one.
+        """
+        key=("T","E",0)
+        self.db.store(key, ("voters",None,None))
+        self.assertEqual(self.db.incr(key,"voters","V1"), ("voters",1,"V1"))
+        self.db.store(key, ("vgters",1,"V1"))
+        self.assertEqual(self.db.incr(key,"voters","V2",3), ("voters",4,"V2"))
+        self.assertEqual(self.db.fetch(key), ("voters",4,"V2"))
+        with self.assertRaises(KeyError):
+            self.db.incr(("T","E",1),"voters")
+    def test_direct(self):
+        """Nothing can fail, so the counter is changed in the database."""
+        self.check()
+    def test_pipeline(self):
+        """Failures are possible, if too rare to happen, so the counter goes
+           through the channels and the cache.
+        """
+        self.db.configure("((1,),1e-15,0,0)")
+        self.check()
+
+class TestBypass(InTempDir):
+    """A Broker skips the channels and cache while nothing can fail."""
+    def setUp(self):
+        super().setUp()
+        self.db=crusher.Broker("test", crusher.storages["memory"]("test"))
+        self.db.configure(QUIET)
+    def test_direct(self):
+        """Operations go straight to the database, and lists are still
+           frozen into tuples.
+        """
+        self.assertTrue(self.db.direct)
+        self.assertIs(self.db.keyIn.mangle, crusher.freeze)
+        self.db.store(["a","S"], ["CAST"])
+        self.assertEqual(self.db.db.fetch(("a","S")), ("CAST",))
+        self.assertEqual(self.db.cache.stats()["entries"], 0)
+    def test_failures_turned_back_on(self):
+        """The cache missed the changes made while it was bypassed, so it
+           is emptied when failures are possible again.
+        """
+        noisy="((1,),1e-15,0,0)"
+        self.db.configure(noisy)
+        self.db.store("a", 1)
+        self.db.configure(QUIET)
+        self.db.store("a", 2)
+        self.db.configure(noisy)
+        self.assertFalse(self.db.direct)
+        self.assertEqual(self.db.fetch("a"), 2)
+
+class TestDataBase(InTempDir):
+    """Saving and loading DataBase snapshots."""
+    def test_text_dump_is_exported(self):
+        """The default storage does not write the text dump, and export
+           writes it from the saved snapshot and history.
+        """
+        db=crusher.storages["memory"]("test")
+        db.store(("T","N"), 3)
+        db.save([(QUIET,"CONF")])
+        db.close()
+        self.assertFalse(os.path.exists("test-db.txt"))
+        crusher.DataBase("test").export()
+        with open("test-db.txt") as f:
+            text=f.read()
+        self.assertIn(QUIET, text)
+        self.assertIn("('T', 'N')\t3", text)
+    def test_failed_save_keeps_previous(self):
+        """A save that fails part way leaves the previous save whole."""
+        db=crusher.DataBase("test", text=False)
+        db.store("a", 1)
+        db.save([])
+        db.store("b", lambda: None)
+        with self.assertRaises(Exception):
+            db.save([])
+        self.assertEqual(dict(crusher.DataBase("test").items()), {"a":1})
+    def test_background_snapshot(self):
+        """A snapshot written in the background holds the database as it
+           was when it was saved.
+        """
+        db=crusher.DataBase("test", background=True, text=False)
+        db.store("a", 1)
+        db.save([])
+        db.store("a", 2)
+        db.close()
+        self.assertEqual(crusher.DataBase("test").fetch("a"), 1)
+
+class TestSQLiteDataBase(InTempDir):
+    """SQLiteDataBase, which keeps the database in an SQLite file."""
+    def test_persists(self):
+        """What is stored is there when the database is opened again."""
+        db=crusher.SQLiteDataBase("test", batch=3)
+        db.store(("T","N"), 2)
+        db.store_many([("T","E",0),("T","E",1)], [("a",1,None),("b",2,None)])
+        self.assertEqual(db.remove(("T","E",1)), ("b",2,None))
+        with self.assertRaises(KeyError):
+            db.remove(("T","E",1))
+        db.save([])
+        db.close()
+        db=crusher.SQLiteDataBase("test")
+        self.assertEqual(dict(db.items()),
+                         {("T","N"):2, ("T","E",0):("a",1,None)})
+        db.close()
+    def test_equal_keys(self):
+        """Keys that are equal are the same key, even if one of them shares
+           objects that the other does not.
+        """
+        db=crusher.SQLiteDataBase("test")
+        shared="Mayor"
+        db.store(("X",(shared,shared)), 1)
+        self.assertEqual(db.fetch(("X",("".join(["May","or"]),shared))), 1)
+        db.close()
+    def test_broker(self):
+        """A Broker can use it by name."""
+        db=crusher.Broker("test", crusher.storages["sqlite"]("test"))
+        db.configure(QUIET)
+        db.store(("a","S"), "CAST")
+        db.exit()
+        db=crusher.storages["sqlite"]("test")
+        self.assertEqual(db.fetch(("a","S")), "CAST")
+        db.close()
+
+class TestShardedBroker(InTempDir):
+    """ShardedBroker keeps each dictlist in one shard."""
+    def setUp(self):
+        super().setUp()
+        self.db=crusher.ShardedBroker("test", 4, "memory")
+        self.db.configure(QUIET)
+    def tearDown(self):
+        self.db.exit()
+        super().tearDown()
+    def test_compact_keys(self):
+        """Every packed key of a compact dictlist is in the shard of its
+           name, which is the shard of its tuple keys.
+        """
+        symbols=crusherdict.SymbolTable(self.db)
+        for name in ["V{:06}".format(i) for i in range(20)]:
+            d=crusherdict.CrusherDict(self.db, name, symbols=symbols)
+            d.status("CAST")
+            d.getKey(("Mayor","Ann"))
+            d.getKey(("Clerk","Dee"))
+            shard=self.db.route(crusherdict.statusName(name))
+            keys=[d.statusKey(), d.countKey(), d.entryKey(0),
+                  d.entryKey(1), d.indexKey(d.stored(("Clerk","Dee")))]
+            self.assertEqual({self.db.route(k) for k in keys}, {shard})
+            for k in keys:
+                self.db.shards[shard].db.fetch(k)
+    def test_spread(self):
+        """The dictlists are spread over every shard, and fetch_many puts
+           the values from each shard back in the order of the keys.
+        """
+        keys=[("D{}".format(i),"E",0) for i in range(40)]
+        self.db.store_many([(k, i) for (i, k) in enumerate(keys)])
+        self.assertEqual({self.db.route(k) for k in keys}, set(range(4)))
+        for (i, k) in enumerate(keys):
+            self.assertEqual(self.db.shards[self.db.route(k)].db.fetch(k), i)
+        missing=("D0","E",1)
+        self.assertEqual(self.db.fetch_many(keys[::-1]+[missing], -1),
+                         list(range(39,-1,-1))+[-1])
+    def test_persist(self):
+        """Each shard persists its own keys, and a new ShardedBroker on the
+           same files finds them.
+        """
+        keys=[("D{}".format(i),"E",0) for i in range(40)]
+        self.db.store_many([(k, i) for (i, k) in enumerate(keys)])
+        self.db.exit()
+        self.db=crusher.ShardedBroker("test", 4, "memory")
+        self.db.configure(QUIET)
+        self.assertEqual(self.db.fetch_many(keys), list(range(40)))
+
+if __name__=="__main__":
+    unittest.main()
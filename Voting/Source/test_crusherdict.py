@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+""" Tests for CrusherDict on the databases that it can be built on.
+
+MIT License
+
+Copyright (c) 2016 Steven P. Crain, SUNY Plattsburgh
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import crusher
+import crusherdict
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+"""Configuration that turns off every failure."""
+QUIET="((0,1,2,3,4,5,6,7,8),0,0,0,0,0)"
+
+class Requests:
+    """Wraps a database, and counts the requests made of it by method."""
+    def __init__(self, db):
+        self.db=db
+        self.count={}
+    def __getattr__(self, name):
+        method=getattr(self.db, name)
+        if name not in ("store", "fetch", "incr", "store_many", "fetch_many",
+                        "remove"):
+            return method
+        def request(*args, **kwargs):
+            self.count[name]=self.count.get(name,0)+1
+            return method(*args, **kwargs)
+        return request
+
+class InTempDir(unittest.TestCase):
+    """Runs each test in a new directory, since databases persist to files
+       in the current directory.
+    """
+    def setUp(self):
+        self.home=os.getcwd()
+        self.dir=tempfile.TemporaryDirectory()
+        os.chdir(self.dir.name)
+    def tearDown(self):
+        os.chdir(self.home)
+        self.dir.cleanup()
+
+class TestProcessShards(InTempDir):
+    """CrusherDict on a ShardedBroker whose shards run in other processes."""
+    def setUp(self):
+        super().setUp()
+        self.db=crusher.ShardedBroker("test", 2, "memory", True)
+        self.db.configure(QUIET)
+    def tearDown(self):
+        self.db.exit()
+        super().tearDown()
+    def test_fetch_many_default(self):
+        """The caller's default comes back for missing keys, as itself."""
+        default=object()
+        self.db.store(("a","E",0), 1)
+        vals=self.db.fetch_many([("a","E",0),("a","E",1),("b","E",0)], default)
+        self.assertEqual(vals[0], 1)
+        self.assertIs(vals[1], default)
+        self.assertIs(vals[2], default)
+    def test_missing_item(self):
+        """Iterating reaches an item that is missing, and raises KeyError."""
+        d=crusherdict.CrusherDict(self.db, "D")
+        d.getKey("a", 1)
+        self.db.store(crusherdict.countName("D"), 2)
+        with self.assertRaises(KeyError):
+            list(d)
+    def test_group_skips_missing(self):
+        """A grouped item that is missing is left out of its group."""
+        t=crusherdict.CrusherDict(self.db, "T", grouped=True)
+        t.inc(("Mayor","Ann"))
+        t.inc(("Mayor","Bob"))
+        t.inc(("Mayor","Bob"))
+        self.db.remove(crusherdict.entryName("T",0))
+        self.assertEqual(t.top("Mayor"), [(("Mayor","Bob"),2,None)])
+
+class TestNoisyDatabase(InTempDir):
+    """CrusherDict on a Broker whose database channels damage keys, so that
+       keys it stored go missing.
+    """
+    def setUp(self):
+        super().setUp()
+        self.db=crusher.Broker("test", crusher.storages["memory"]("test"))
+        self.db.configure(QUIET)
+        self.db.configure("((6,7,8),0.002,0,0)")
+    def test_status_changes(self):
+        """Moving dictlists between status lists does not raise KeyError
+           when the list items it removes or moves are missing.
+        """
+        names=["V{}".format(i) for i in range(300)]
+        for (i, name) in enumerate(names):
+            crusherdict.CrusherDict(self.db, name,
+                                    indexed=("UNCAST",)).status("UNCAST")
+            if i>=3:
+                crusherdict.CrusherDict(self.db, names[i-3],
+                                        indexed=("UNCAST",)).status("CAST")
+
+class TestLocalCopy(InTempDir):
+    """CrusherDict with a local copy of its index and number of items."""
+    def setUp(self):
+        super().setUp()
+        self.db=crusher.Broker("test", crusher.storages["memory"]("test"))
+        self.db.configure(QUIET)
+    def test_lookups_are_local(self):
+        """Lookups between checks do not read the database."""
+        requests=Requests(self.db)
+        d=crusherdict.CrusherDict(requests, "D", local=True, checkEvery=10)
+        d.getKey("a")
+        d.getKey("b")
+        requests.count.clear()
+        self.assertEqual([d.indexOf("a") for i in range(3)], [0,0,0])
+        self.assertEqual(d.itemCount(), 2)
+        self.assertEqual(requests.count, {})
+    def test_other_writer(self):
+        """A change by another writer is noticed at the next check, and the
+           copy is discarded.
+        """
+        d=crusherdict.CrusherDict(self.db, "D", local=True, checkEvery=5)
+        d.getKey("a")
+        d.getKey("b")
+        crusherdict.CrusherDict(self.db, "D").discard("a")
+        found=[d.indexOf("b") for i in range(5)]
+        self.assertEqual((found[0], found[-1]), (1, 0))
+        self.assertEqual(d.mismatches, 1)
+
+class TestInc(InTempDir):
+    """CrusherDict.inc on a quiet Broker."""
+    def setUp(self):
+        super().setUp()
+        self.db=crusher.Broker("test", crusher.storages["memory"]("test"))
+        self.db.configure(QUIET)
+    def test_inc(self):
+        """An item that is there is incremented by the database, without
+           reading or storing it.
+        """
+        t=crusherdict.CrusherDict(self.db, "T")
+        t.inc("voters", "V1")
+        requests=Requests(self.db)
+        crusherdict.CrusherDict(requests, "T").inc("voters", "V2", 2)
+        self.assertEqual(requests.count, {"fetch":1, "incr":1})
+        self.assertEqual(t.get("voters"), ("voters",3,"V2"))
+
+class TestConcurrentBroker(InTempDir):
+    """CrusherDict shared by threads on a concurrent Broker."""
+    def setUp(self):
+        super().setUp()
+        self.db=crusher.Broker("test", crusher.storages["memory"]("test"),
+                               concurrent=True)
+        self.db.configure(QUIET)
+        """Switch threads often, so that they interleave."""
+        self.interval=sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+    def tearDown(self):
+        sys.setswitchinterval(self.interval)
+        super().tearDown()
+    def test_no_lost_updates(self):
+        """Threads that increment the same tallies, over a cache too small
+           to hold them, neither lose increments nor add a tally twice.
+        """
+        keys=[("Mayor","V{}".format(i)) for i in range(40)]
+        for policy in crusher.EVICTION_POLICIES:
+            with self.subTest(policy=policy):
+                self.db.configure("((0,),1000,0,0,0,0,8,'{}')".format(policy))
+                t=crusherdict.CrusherDict(self.db, "T"+policy)
+                def vote():
+                    for key in keys+keys:
+                        t.inc(key)
+                threads=[threading.Thread(target=vote) for i in range(8)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                self.assertEqual(sorted((item[0], item[1]) for item in t),
+                                 sorted((key, 16) for key in keys))
+
+class TestStatusIndex(InTempDir):
+    """Listing dictlists by status, on a quiet Broker."""
+    def setUp(self):
+        super().setUp()
+        self.db=crusher.Broker("test", crusher.storages["memory"]("test"))
+        self.db.configure(QUIET)
+    def test_discard(self):
+        """discard moves the last item into the place of the one it removes,
+           and reads the index and the number of items with one request.
+        """
+        d=crusherdict.CrusherDict(self.db, "D")
+        for key in ("a","b","c"):
+            d.getKey(key, key.upper())
+        requests=Requests(self.db)
+        crusherdict.CrusherDict(requests, "D").discard("a")
+        self.assertEqual(list(d), [("c","C"),("b","B")])
+        self.assertEqual(requests.count["fetch_many"], 1)
+        self.assertEqual(requests.count["fetch"], 1)
+        requests.count.clear()
+        crusherdict.CrusherDict(requests, "D").discard("a")
+        self.assertEqual(requests.count, {"fetch_many":1})
+    def test_with_status(self):
+        """withStatus reads the statuses of the listed dictlists together,
+           and leaves out the ones whose status changed.
+        """
+        names=["V{}".format(i) for i in range(5)]
+        for name in names:
+            crusherdict.CrusherDict(self.db, name,
+                                    indexed=("UNCAST",)).status("UNCAST")
+        for name in names[1:3]:
+            self.db.store(crusherdict.statusName(name), "CAST")
+        requests=Requests(self.db)
+        self.assertEqual(sorted(crusherdict.withStatus(requests, "UNCAST")),
+                         [names[0]]+names[3:])
+        self.assertEqual(requests.count.get("fetch",0), 1)
+
+class TestNameAllocator(InTempDir):
+    """NameAllocator on a Broker whose records can be damaged or come from
+       before it.
+    """
+    def setUp(self):
+        super().setUp()
+        self.db=crusher.Broker("test", crusher.storages["memory"]("test"))
+        self.db.configure(QUIET)
+    def test_damaged_counter(self):
+        """A counter that went back is not trusted to hand out names
+           again.
+        """
+        first=crusherdict.NameAllocator(self.db, "V", block=4)
+        names={first() for i in range(8)}
+        a=crusherdict.CrusherDict(self.db, "A")
+        self.db.store(a.getKey(first.counter), (first.counter, 0, None))
+        second=crusherdict.NameAllocator(self.db, "V", block=4)
+        self.assertFalse(names & {second() for i in range(8)})
+    def test_legacy_names(self):
+        """In a database from before allocators, names that are in use are
+           skipped, and in a new one they are not looked up.
+        """
+        names=[crusherdict.NameAllocator(self.db, "V").name(i)
+               for i in range(4)]
+        crusherdict.CrusherDict(self.db, names[0]).status("CAST")
+        crusherdict.CrusherDict(self.db, names[2]).getKey("Mayor")
+        allocate=crusherdict.NameAllocator(self.db, "V", legacy=True)
+        self.assertEqual([allocate(), allocate()], [names[1], names[3]])
+        self.assertEqual(crusherdict.CrusherDict(self.db, "A").status(),
+                         "PROBE")
+    def test_new_database(self):
+        """In a new database, names are handed out without lookups."""
+        names=[crusherdict.NameAllocator(self.db, "V").name(i)
+               for i in range(2)]
+        crusherdict.CrusherDict(self.db, names[0]).status("CAST")
+        allocate=crusherdict.NameAllocator(self.db, "V")
+        self.assertEqual(allocate(), names[0])
+        self.assertEqual(crusherdict.CrusherDict(self.db, "A").status(),
+                         "COUNT")
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+""" Tests for serving a Broker to BrokerClients.
+
+MIT License
+
+Copyright (c) 2016 Steven P. Crain, SUNY Plattsburgh
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import asyncio
+import crusher
+import crusherserver
+import os
+import tempfile
+import threading
+import unittest
+
+"""Configuration that turns off every failure."""
+QUIET="((0,1,2,3,4,5,6,7,8),0,0,0,0,0)"
+
+class TestBrokerClient(unittest.TestCase):
+    """BrokerClient on a BrokerServer that runs in another thread."""
+    def setUp(self):
+        self.home=os.getcwd()
+        self.dir=tempfile.TemporaryDirectory()
+        os.chdir(self.dir.name)
+        broker=crusher.Broker("test", crusher.storages["memory"]("test"))
+        self.service=crusherserver.BrokerServer(broker)
+        self.loop=asyncio.new_event_loop()
+        self.server=self.loop.run_until_complete(asyncio.start_unix_server(
+            self.service.handle, "test.sock"))
+        self.thread=threading.Thread(target=self.loop.run_forever,
+                                     daemon=True)
+        self.thread.start()
+        self.db=crusherserver.BrokerClient("test.sock")
+        self.db.configure(QUIET)
+    def tearDown(self):
+        try:
+            self.db.exit()
+            asyncio.run_coroutine_threadsafe(self.disconnected(),
+                                             self.loop).result(10)
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.server.close()
+            self.loop.close()
+            os.chdir(self.home)
+            self.dir.cleanup()
+    async def disconnected(self):
+        """Wait for the server to finish with its clients."""
+        while self.service.clients:
+            await asyncio.sleep(0.01)
+    def test_store_errors(self):
+        """The error of a store is raised once, by flush, and not by the
+           calls after it. The stores around it are performed.
+        """
+        self.db.store(("a","E",0), 1)
+        self.db.store({}, 2)
+        self.db.store(("b","E",0), 3)
+        self.assertEqual(self.db.fetch(("a","E",0)), 1)
+        with self.assertRaises(TypeError):
+            self.db.flush()
+        self.db.flush()
+        self.assertEqual(self.db.fetch(("b","E",0)), 3)
+    def test_configure_error(self):
+        """A configuration message that is rejected raises at once."""
+        with self.assertRaises(Exception):
+            self.db.configure("((0,1),")
+        self.db.store(("a","E",0), 1)
+        self.db.flush()
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+""" Tests for running demo.py on a whole input file.
+
+MIT License
+
+Copyright (c) 2016 Steven P. Crain, SUNY Plattsburgh
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import crusher
+import crusherdict
+import demo
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import unittest
+
+DEMO=os.path.join(os.path.dirname(os.path.abspath(__file__)), "demo.py")
+"""Configuration that turns off every failure."""
+QUIET=["CONF\t(0,0,0,0,0,0)", "CONF\t((1,2,3,4,5,6,7,8),0,0,0)"]
+OFFICES={"Mayor":["Ann","Bob","Cy"], "Clerk":["Dee","Eve"]}
+
+def election(voters, seed=1):
+    """Return the lines of an input file with voters voters, and TALLY
+       commands between voters and in the middle of voters.
+    """
+    rng=random.Random(seed)
+    lines=list(QUIET)
+    for i in range(voters):
+        lines.append("VOTER")
+        for (office, candidates) in sorted(OFFICES.items()):
+            lines.append("VOTE\t{}\t{}".format(office, rng.choice(candidates)))
+            if i%7==3:
+                lines.append("TALLY\t{}\t2".format(office))
+        lines.append("CAST")
+        if i%5==0:
+            lines.append("TALLY\tMayor")
+    return lines
+
+def run(directory, lines, *args):
+    """Run demo.py in directory on lines, with args, and return the
+       votelog, without voterids, and the sorted results. The input starts
+       with QUIET, which is in effect before the database is read, so
+       nothing can fail and the run is the same every time.
+    """
+    with open(os.path.join(directory, "election.txt"), "w") as f:
+        f.write("\n".join(lines)+"\n")
+    done=subprocess.run([sys.executable, DEMO, "election.txt"]+list(args),
+                        cwd=directory, capture_output=True, text=True,
+                        timeout=120)
+    if done.returncode!=0:
+        raise AssertionError("demo.py failed: "+done.stderr)
+    with open(os.path.join(directory, "election-votelog.txt")) as f:
+        log=[line if not line.startswith("CAST\t") else "CAST"
+             for line in f.read().splitlines()]
+    with open(os.path.join(directory, "election-results.txt")) as f:
+        results=sorted(f.read().splitlines())
+    return (log, results)
+
+class InTempDir(unittest.TestCase):
+    """Runs each test in a new directory, for the files demo.py writes."""
+    def setUp(self):
+        self.dir=tempfile.TemporaryDirectory()
+        self.path=self.dir.name
+    def tearDown(self):
+        self.dir.cleanup()
+    def broker(self):
+        """Return a quiet Broker on the database demo.py uses."""
+        db=crusher.Broker("election", crusher.storages["memory"](
+            os.path.join(self.path, "election")))
+        db.configure(QUIET[0].split("\t")[1])
+        db.configure(QUIET[1].split("\t")[1])
+        return db
+
+class TestWorkers(InTempDir):
+    """demo.py with --workers writes what it writes without them."""
+    def test_tally_between_and_inside_voters(self):
+        """TALLY commands see the same voters with and without workers,
+           and a voter that a TALLY interrupts is still cast.
+        """
+        lines=election(40)
+        (log, results)=run(self.path, lines)
+        self.assertIn("VOTERS\t40", results)
+        self.assertEqual(log.count("CAST"), 40)
+        with tempfile.TemporaryDirectory() as other:
+            self.assertEqual(run(other, lines, "--workers", "2"),
+                             (log, results))
+
+class TestGroup(InTempDir):
+    """demo.py with --group writes what it writes without it."""
+    def test_group_commit(self):
+        """Voters committed together, whether their groups fill up or run
+           out of time, get the same receipts and tallies.
+        """
+        lines=election(40)
+        expected=run(self.path, lines)
+        for args in (["--group", "8"], ["--group", "8", "--latency", "0"]):
+            with tempfile.TemporaryDirectory() as other:
+                self.assertEqual(run(other, lines, *args), expected)
+
+class TestTally(InTempDir):
+    """TALLY on a database that demo.py did not start."""
+    def test_tallies_from_before_grouping(self):
+        """Tallies added before they were grouped are in the standings."""
+        db=self.broker()
+        t=crusherdict.CrusherDict(db, "T")
+        t.inc("voters", None, 3)
+        t.inc(("Mayor","Cy"), None, 3)
+        db.exit()
+        (log, results)=run(self.path, QUIET+["TALLY\tMayor"])
+        self.assertEqual(log[-1], "TALLY\tMayor\tCy\t3")
+        self.assertIn("VOTERS\t3", results)
+
+class TestRestart(InTempDir):
+    """Resuming from the checkpoint of a run that did not finish."""
+    def interrupted(self, lines):
+        """Run demo.py on lines, and then leave the checkpoint as if it had
+           stopped just before it finished.
+        """
+        run(self.path, lines)
+        demo.source.update(file=os.path.join(self.path, "election.txt"),
+                           prefix=(0,0))
+        logged=os.path.getsize(os.path.join(self.path, "election-votelog.txt"))
+        db=self.broker()
+        demo.checkpoint(db, os.path.getsize(demo.source["file"]), logged,
+                        [line.split("\t")[1] for line in QUIET])
+        db.exit()
+    def test_appended_input(self):
+        """Commands appended to the input after the checkpoint are run,
+           and the ones before it are not run again.
+        """
+        lines=election(30)
+        self.interrupted(lines[:lines.index("VOTER", len(lines)//2)])
+        with tempfile.TemporaryDirectory() as other:
+            self.assertEqual(run(self.path, lines), run(other, lines))
+    def test_changed_input(self):
+        """A checkpoint is not used on an input whose commands before it
+           have changed.
+        """
+        lines=election(30)
+        self.interrupted(lines[:lines.index("VOTER", len(lines)//2)])
+        lines[3]="VOTE\tClerk\tNobody"
+        with self.assertRaisesRegex(AssertionError, "does not start with"):
+            run(self.path, lines)
+
+class TestNames(InTempDir):
+    """How demo.py has names allocated in the database it runs on."""
+    def scheme(self):
+        """Return the status of the allocators' dictlist after a run."""
+        db=self.broker()
+        stat=crusherdict.CrusherDict(db, "A").status()
+        db.exit()
+        return stat
+    def test_new_database(self):
+        """A new database hands out names without looking them up."""
+        run(self.path, election(3))
+        self.assertEqual(self.scheme(), "COUNT")
+    def test_legacy_database(self):
+        """A database with voters from before allocators has its names
+           looked up.
+        """
+        db=self.broker()
+        crusherdict.CrusherDict(db, "VOLD123").status("CAST")
+        crusherdict.CrusherDict(db, "T").inc("voters", "VOLD123")
+        db.exit()
+        (log, results)=run(self.path, election(3))
+        self.assertIn("VOTERS\t4", results)
+        self.assertEqual(self.scheme(), "PROBE")
+
+if __name__=="__main__":
+    unittest.main()